@@ -0,0 +1,88 @@
+"""
+On-disk cache of monodepth disparity maps.
+
+Entries are keyed by the SHA-256 of the encoded image, the depth model
+name and the working resolution, and hold the normalized disparity as
+compressed float16. The cache is bounded in size: after every write the
+least recently used entries are evicted. Writes are atomic, so several
+processes can share one cache directory.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+
+
+def content_hash(source):
+    """SHA-256 of a file (given its path) or of encoded image bytes"""
+    digest = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray)):
+        digest.update(source)
+    else:
+        with open(source, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DepthCache(object):
+    """Size-bounded LRU cache of disparity maps in cache_dir"""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_args(cls, args):
+        """Cache for --depth-cache and --depth-cache-size (in MB), or None if it is disabled"""
+        if not getattr(args, 'depth_cache', None):
+            return None
+        return cls(args.depth_cache, int(args.depth_cache_size * (1 << 20)))
+
+    def key(self, source, model_name, size):
+        """Cache key of an image (path or bytes) run through model_name at size (width, height)"""
+        return hashlib.sha256(f"{content_hash(source)}:{model_name}:{size[0]}x{size[1]}".encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """The cached disparity as float32, or None. A hit marks the entry as recently used"""
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                disp = entry['disp'].astype(np.float32)
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return disp
+
+    def put(self, key, disp):
+        """Store a disparity map, then evict least recently used entries beyond max_bytes"""
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as fp:
+            np.savez_compressed(fp, disp=disp.astype(np.float16))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
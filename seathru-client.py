@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Thin client for the Sea-Thru service started with
+`seathru-mono-e2e.py --serve`. The server keeps the depth model
+loaded, so each request only pays for the processing itself.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import pynng
+
+from seathru_ipc import DEFAULT_ADDRESS, REQUEST_PARAMS, decode_message, encode_message
+
+
+def request(address, header, payload=b'', timeout=None):
+    """Send one request and wait for the response; returns (header, payload)"""
+    with pynng.Req0(dial=address, recv_timeout=timeout) as sock:
+        sock.send(encode_message(header, payload))
+        return decode_message(sock.recv())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send an image to a running Sea-Thru service')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='pynng address of the service')
+    parser.add_argument('--image', help='Input image')
+    parser.add_argument('--output', help='Output file (PNG for enhance, .npy for depth)')
+    parser.add_argument('--depth', action='store_true', help='Request the depth map instead of the enhanced image')
+    parser.add_argument('--ping', action='store_true', help='Only check that the service answers')
+    parser.add_argument('--send-bytes', action='store_true',
+                        help='Send the file contents instead of its path (for servers without access to the file)')
+    parser.add_argument('--raw', action='store_true', default=None, help='RAW image')
+    parser.add_argument('--timeout', type=int, default=None, help='Receive timeout in milliseconds')
+    for name, kind in REQUEST_PARAMS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=kind, default=None, help=f'Override {name} for this request')
+    args = parser.parse_args()
+
+    if args.ping:
+        start = time.perf_counter()
+        request(args.address, {'op': 'ping'}, timeout=args.timeout)
+        print(f'Service at {args.address} answered in {time.perf_counter() - start:.3f}s')
+        return
+    if not args.image:
+        parser.error('Must specify --image or --ping')
+
+    op = 'depth' if args.depth else 'enhance'
+    output = args.output or os.path.splitext(os.path.basename(args.image))[0] + ('_depth.npy' if args.depth else '_seathru.png')
+    header = {'op': op, 'output': output}
+    params = {name: getattr(args, name) for name in REQUEST_PARAMS if getattr(args, name) is not None}
+    if params:
+        header['params'] = params
+    if args.raw is not None:
+        header['raw'] = args.raw
+    payload = b''
+    if args.send_bytes:
+        with open(args.image, 'rb') as fp:
+            payload = fp.read()
+    else:
+        header['path'] = os.path.abspath(args.image)
+
+    start = time.perf_counter()
+    response, data = request(args.address, header, payload, args.timeout)
+    if not response['ok']:
+        print(f"Error: {response['error']}", file=sys.stderr)
+        sys.exit(1)
+    with open(output, 'wb') as fp:
+        fp.write(data)
+    print(f"Saved: {output} ({response['seconds']:.2f}s on the server, {time.perf_counter() - start:.2f}s total)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Distributes a directory of images over Sea-Thru workers.
+
+The coordinator pushes one job per image on a pynng Push0 socket and
+collects the outcomes on a Pull0 socket. Workers are
+`seathru-mono-e2e.py --worker` processes on this host (--local-workers)
+or on other hosts that dial the same addresses and see the same paths.
+Failed or timed out jobs are retried, and the state of every job is
+kept in a JSON ledger so an interrupted run resumes where it stopped.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from urllib.parse import urlsplit
+
+import pynng
+
+from seathru_ipc import (DEFAULT_JOBS_ADDRESS, DEFAULT_RESULTS_ADDRESS, decode_message, encode_message,
+                         find_images, output_path_for)
+
+
+def load_ledger(ledger_path, image_files, output_dir):
+    """Job ledger keyed by image path. Done jobs from an earlier run are kept, the others start over"""
+    ledger = {}
+    if os.path.exists(ledger_path):
+        with open(ledger_path) as fp:
+            ledger = json.load(fp)
+    for image_path in image_files:
+        job = ledger.setdefault(image_path, {'output': output_path_for(image_path, output_dir), 'attempts': 0})
+        if job.get('status') != 'done':
+            job.update(status='pending', attempts=0)
+    return ledger
+
+
+def save_ledger(ledger, ledger_path):
+    """Write the ledger atomically, so a crash never leaves it half written"""
+    tmp_path = ledger_path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(ledger, fp, indent=2)
+    os.replace(tmp_path, ledger_path)
+
+
+def local_address(address):
+    """Address for a worker on this host to dial when the coordinator listens on all interfaces"""
+    parts = urlsplit(address)
+    if parts.scheme == 'tcp' and parts.hostname in ('*', '0.0.0.0', ''):
+        return f"tcp://127.0.0.1:{parts.port}"
+    return address
+
+
+def start_local_workers(count, args, worker_args):
+    """Start seathru-mono-e2e.py --worker processes dialing the coordinator"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seathru-mono-e2e.py')
+    command = [sys.executable, script, '--worker', '--jobs-address', local_address(args.jobs_address),
+               '--results-address', local_address(args.results_address)] + worker_args
+    if args.raw:
+        command.append('--raw')
+    processes = []
+    for idx in range(count):
+        log = open(os.path.join(args.output_dir, f"worker-{idx}.log"), 'w')
+        processes.append(subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT))
+    print(f"Started {count} local workers (logs in {args.output_dir})")
+    return processes
+
+
+def coordinate(ledger, args, processes=()):
+    """Push pending jobs, at most args.max_in_flight at a time, and record results until every job is done
+    or has failed args.retries + 1 times. Jobs without a result after args.job_timeout seconds count as
+    failed attempts. Stops early if all the local worker processes have exited"""
+    running = {}
+
+    def retry_or_fail(image_path, job, error):
+        job['error'] = error
+        job['status'] = 'pending' if job['attempts'] <= args.retries else 'failed'
+        if job['status'] == 'failed':
+            print(f"[FAILED] {os.path.basename(image_path)}: {error}")
+
+    with pynng.Push0(listen=args.jobs_address, send_timeout=1000) as jobs, \
+            pynng.Pull0(listen=args.results_address, recv_timeout=1000) as results:
+        print(f"Pushing jobs on {args.jobs_address}, collecting results on {args.results_address}")
+        while True:
+            pending = [image_path for image_path, job in ledger.items() if job['status'] == 'pending']
+            if not pending and not running:
+                break
+            for image_path in pending[:max(0, args.max_in_flight - len(running))]:
+                job = ledger[image_path]
+                message = encode_message({'id': image_path, 'path': image_path, 'output': job['output'],
+                                          'attempt': job['attempts'] + 1})
+                try:
+                    jobs.send(message)
+                except pynng.Timeout:
+                    break
+                job['attempts'] += 1
+                job['status'] = 'running'
+                running[image_path] = time.time()
+                save_ledger(ledger, args.ledger)
+
+            try:
+                result, _ = decode_message(results.recv())
+            except pynng.Timeout:
+                result = None
+            if result is not None:
+                image_path = result['id']
+                job = ledger.get(image_path)
+                # results of attempts that already timed out are stale
+                if job is not None and job['status'] == 'running' and result['attempt'] == job['attempts']:
+                    del running[image_path]
+                    job.update(worker=result['worker'], seconds=round(result['seconds'], 2))
+                    if result['ok']:
+                        job['status'] = 'done'
+                        job.pop('error', None)
+                        print(f"[OK] {os.path.basename(image_path)} ({result['seconds']:.1f}s on {result['worker']})")
+                    else:
+                        retry_or_fail(image_path, job, result['error'])
+                    save_ledger(ledger, args.ledger)
+
+            if processes and all(process.poll() is not None for process in processes):
+                raise RuntimeError(f"All local workers exited, see the worker logs in {args.output_dir}")
+
+            now = time.time()
+            for image_path, started in list(running.items()):
+                if now - started > args.job_timeout:
+                    del running[image_path]
+                    retry_or_fail(image_path, ledger[image_path], f"no result after {args.job_timeout}s")
+                    save_ledger(ledger, args.ledger)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Distribute Sea-Thru batch processing over local and remote workers',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Arguments not listed here are passed on to the local workers, e.g.
+  python seathru-coordinator.py --input-dir ./dive --output-dir ./out --local-workers 4 --f 2.5
+
+Remote workers dial the coordinator and need the same paths (shared storage):
+  python seathru-mono-e2e.py --worker --jobs-address tcp://coordinator:5560 --results-address tcp://coordinator:5561
+        """)
+    parser.add_argument('--input-dir', required=True, help='Directory of images to process')
+    parser.add_argument('--output-dir', default='output', help='Output directory')
+    parser.add_argument('--raw', action='store_true', help='Include RAW files')
+    parser.add_argument('--local-workers', type=int, default=0, help='Worker processes to start on this host')
+    parser.add_argument('--jobs-address', default=DEFAULT_JOBS_ADDRESS, help='Address to push jobs on')
+    parser.add_argument('--results-address', default=DEFAULT_RESULTS_ADDRESS, help='Address to collect results on')
+    parser.add_argument('--ledger', default=None, help='Job ledger (default: ledger.json in the output directory)')
+    parser.add_argument('--retries', type=int, default=2, help='Retries for a failed or timed out job')
+    parser.add_argument('--job-timeout', type=float, default=600.0, help='Seconds before a job without result is retried')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Jobs handed out without a result yet (default: twice the local workers, at least 4)')
+    args, worker_args = parser.parse_known_args()
+
+    # workers on other hosts resolve the paths themselves, so hand out absolute ones
+    args.output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    args.ledger = args.ledger or os.path.join(args.output_dir, 'ledger.json')
+    args.max_in_flight = args.max_in_flight or max(4, 2 * args.local_workers)
+    image_files = [os.path.abspath(image_path) for image_path in find_images(args.input_dir, args.raw)]
+    if not image_files:
+        print(f"No images found in {args.input_dir}")
+        sys.exit(0)
+    ledger = load_ledger(args.ledger, image_files, args.output_dir)
+    save_ledger(ledger, args.ledger)
+    done = sum(job['status'] == 'done' for job in ledger.values())
+    print(f"Found {len(image_files)} images, {done} already done")
+
+    processes = start_local_workers(args.local_workers, args, worker_args) if args.local_workers else []
+    start = time.time()
+    try:
+        coordinate(ledger, args, processes)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        for process in processes:
+            process.terminate()
+
+    failed = [image_path for image_path, job in ledger.items() if job['status'] == 'failed']
+    print(f"\nProcessed {len(ledger) - len(failed)}/{len(ledger)} images in {time.time() - start:.1f}s")
+    if failed:
+        print(f"{len(failed)} failed, see {args.ledger}")
+    print(f"Output saved to: {args.output_dir}")
@@ -2,10 +2,15 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
-import glob
 import argparse
 import time
 import io
+import contextlib
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import socket
 
 import numpy as np
 import PIL.Image as pil
@@ -22,57 +27,477 @@ from deps.monodepth2.layers import disp_to_depth
 from deps.monodepth2.utils import download_model_if_doesnt_exist
 
 from seathru import *
+from depth_cache import DepthCache
+from seathru_ipc import (DEFAULT_ADDRESS, DEFAULT_JOBS_ADDRESS, DEFAULT_RESULTS_ADDRESS, REQUEST_PARAMS,
+                         decode_message, encode_message, encode_array, find_images, output_path_for)
 
 
-def process_single_image(image_path, output_path, encoder, depth_decoder, device, feed_width, feed_height, args):
-    """Process a single image"""
-    print(f"\nProcessing: {image_path}")
-    
-    # Load image and preprocess
-    img = Image.fromarray(rawpy.imread(image_path).postprocess()) if args.raw else pil.open(image_path).convert('RGB')
+def find_sidecar(sidecar, output_path):
+    """Resolve --sidecar: a sidecar file is used as is, a directory is searched for the output's sidecar"""
+    if sidecar and os.path.isdir(sidecar):
+        return os.path.join(sidecar, os.path.basename(sidecar_paths(output_path)[0]))
+    return sidecar
+
+
+def decode_image(image_path, args, raw=None):
+    """Load an image (a path or a file object), shrunk to args.max_size if it is larger"""
+    raw = args.raw if raw is None else raw
+    img = Image.fromarray(decode_raw(image_path, args.max_size)) if raw else pil.open(image_path).convert('RGB')
     original_width, original_height = img.size
-    
+
     # Only resize if image is larger than max_size (if specified)
     if args.max_size and max(original_width, original_height) > args.max_size:
         img.thumbnail((args.max_size, args.max_size), Image.ANTIALIAS)
-        resized_width, resized_height = img.size
-    else:
-        resized_width, resized_height = original_width, original_height
     # img = exposure.equalize_adapthist(np.array(img), clip_limit=0.03)
     # img = Image.fromarray((np.round(img * 255.0)).astype(np.uint8))
-    input_image = img.resize((feed_width, feed_height), pil.LANCZOS)
-    input_image = transforms.ToTensor()(input_image).unsqueeze(0)
-    print('Preprocessed image', flush=True)
+    return img
+
+
+def predict_disparities(imgs, encoder, depth_decoder, device, feed_width, feed_height):
+    """Monodepth disparity of every image, upsampled to its size and normalized to [0, 1]"""
+    input_images = torch.stack([transforms.ToTensor()(img.resize((feed_width, feed_height), pil.LANCZOS)) for img in imgs])
 
     # PREDICTION
-    input_image = input_image.to(device)
-    features = encoder(input_image)
-    outputs = depth_decoder(features)
-
-    disp = outputs[("disp", 0)]
-    disp_resized = torch.nn.functional.interpolate(
-        disp, (resized_height, resized_width), mode="bilinear", align_corners=False)
-
-    # Saving colormapped depth image
-    disp_resized_np = disp_resized.squeeze().cpu().detach().numpy()
-    mapped_im_depths = ((disp_resized_np - np.min(disp_resized_np)) / (
-            np.max(disp_resized_np) - np.min(disp_resized_np))).astype(np.float32)
+    with torch.no_grad():
+        outputs = depth_decoder(encoder(input_images.to(device)))
+
+    disps = []
+    for img, disp in zip(imgs, outputs[("disp", 0)]):
+        width, height = img.size
+        disp_resized = torch.nn.functional.interpolate(
+            disp.unsqueeze(0), (height, width), mode="bilinear", align_corners=False)
+        disp_resized_np = disp_resized.squeeze().cpu().numpy()
+        disps.append(((disp_resized_np - np.min(disp_resized_np)) / (
+                np.max(disp_resized_np) - np.min(disp_resized_np))).astype(np.float32))
+    return disps
+
+
+def predict_disparities_cached(imgs, sources, encoder, depth_decoder, device, feed_width, feed_height, args):
+    """predict_disparities through the --depth-cache, keyed by the content of each source (an image path or
+    its encoded bytes): only cache misses run through the network. Fresh results are rounded to float16 like
+    cached ones, so hits and misses give the same output"""
+    cache = DepthCache.from_args(args)
+    if cache is None:
+        return predict_disparities(imgs, encoder, depth_decoder, device, feed_width, feed_height)
+    keys = [cache.key(source, args.model_name, img.size) for img, source in zip(imgs, sources)]
+    disps = [cache.get(key) for key in keys]
+    misses = [idx for idx, disp in enumerate(disps) if disp is None]
+    if misses:
+        predicted = predict_disparities([imgs[idx] for idx in misses], encoder, depth_decoder, device,
+                                        feed_width, feed_height)
+        for idx, disp in zip(misses, predicted):
+            cache.put(keys[idx], disp)
+            disps[idx] = disp.astype(np.float16).astype(np.float32)
+    return disps
+
+
+def prepare_image_and_depth(img, disp, args):
+    """Pipeline inputs: the image in [0, 1] and the depth map from its normalized disparity"""
+    depths = preprocess_monodepth_depth_map(disp, args.monodepth_add_depth, args.monodepth_multiply_depth)
+    if args.float32:
+        img = np.asarray(img, dtype=np.float32) / np.float32(255.0)
+    else:
+        img = np.array(img) / 255.0
+    return img, depths
+
+
+def predict_image_and_depth(image_path, encoder, depth_decoder, device, feed_width, feed_height, args):
+    """Load an image and predict its monodepth depth map"""
+    img = decode_image(image_path, args)
+    print('Preprocessed image', flush=True)
+    disp = predict_disparities_cached([img], [image_path], encoder, depth_decoder, device, feed_width, feed_height,
+                                      args)[0]
     print("Processed image", flush=True)
     print('Loading image...', flush=True)
-    depths = preprocess_monodepth_depth_map(mapped_im_depths, args.monodepth_add_depth,
-                                            args.monodepth_multiply_depth)
-    recovered = run_pipeline(np.array(img) / 255.0, depths, args)
+    return prepare_image_and_depth(img, disp, args)
+
+
+def calibrate_dive_model(image_files, encoder, depth_decoder, device, feed_width, feed_height, args):
+    """Fit one water model from args.calibration_frames frames sampled evenly across the dive"""
+    picks = np.unique(np.linspace(0, len(image_files) - 1, min(args.calibration_frames, len(image_files))).astype(int))
+    frames = []
+    for start in range(0, len(picks), args.depth_batch_size):
+        imgs, sources = [], []
+        for idx in picks[start:start + args.depth_batch_size]:
+            print(f"\nCalibration frame: {image_files[idx]}")
+            imgs.append(decode_image(image_files[idx], args))
+            sources.append(image_files[idx])
+        disps = predict_disparities_cached(imgs, sources, encoder, depth_decoder, device, feed_width, feed_height, args)
+        for img, disp in zip(imgs, disps):
+            img, depths = prepare_image_and_depth(img, disp, args)
+            if args.estimate_size and max(img.shape[:2]) > args.estimate_size:
+                img, depths = downsample_for_estimation(img, depths, args.estimate_size)
+            frames.append((img, depths))
+    return calibrate_water_model(frames, args)
+
+
+def process_single_image(image_path, output_path, encoder, depth_decoder, device, feed_width, feed_height, args,
+                         water_model=None):
+    """Process a single image, with a shared dive water model if one is given"""
+    print(f"\nProcessing: {image_path}")
+    img, depths = predict_image_and_depth(image_path, encoder, depth_decoder, device, feed_width, feed_height, args)
+    save_png(enhance(img, depths, output_path, args, water_model), output_path)
+
+
+def enhance(img, depths, output_path, args, water_model=None):
+    """Sea-thru stages for an image and its depth map, then denoise; returns the 8-bit result"""
+    sidecar = find_sidecar(args.sidecar, output_path)
+    if water_model is not None:
+        recovered = apply_model(img, depths, water_model, args)
+    elif sidecar:
+        print(f'Applying model from {sidecar}', flush=True)
+        recovered = apply_model(img, depths, load_model_sidecar(sidecar), args)
+    else:
+        recovered, model = run_pipeline(img, depths, args, return_model=True)
+        if args.save_sidecar:
+            print(f'Saved model to {save_model_sidecar(model, output_path)}', flush=True)
     # recovered = exposure.equalize_adapthist(scale(np.array(recovered)), clip_limit=0.03)
     sigma_est = estimate_sigma(recovered, multichannel=True, average_sigmas=True) / 10.0
     recovered = denoise_tv_chambolle(recovered, sigma_est, multichannel=True)
-    im = Image.fromarray((np.round(recovered * 255.0)).astype(np.uint8))
-    im.save(output_path, format='png')
+    return (np.round(recovered * 255.0)).astype(np.uint8)
+
+
+def save_png(pixels, output_path):
+    Image.fromarray(pixels).save(output_path, format='png')
     print(f'Saved: {output_path}')
 
 
-def run(args):
-    """Function to predict for a single image or folder of images
-    """
+_worker_state = {}
+
+
+def init_worker(args, water_model):
+    """Keep the settings and dive model of a worker process; done once, on its first task"""
+    _worker_state['args'] = args
+    _worker_state['water_model'] = water_model
+
+
+def enhance_in_worker(img, depths, output_path, settings):
+    """Process pool task: returns the 8-bit result (None on failure), the captured log, the error message
+    and the seconds spent, so the parent can encode and report in order. settings is (args, water_model);
+    ProcessPoolExecutor has no initializer before Python 3.7, so every task carries them (both are small)
+    and the worker initializes itself from its first task"""
+    if not _worker_state:
+        init_worker(*settings)
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            pixels = enhance(img, depths, output_path, _worker_state['args'], _worker_state['water_model'])
+    except Exception as e:
+        return None, log.getvalue(), str(e), time.perf_counter() - start
+    return pixels, log.getvalue(), None, time.perf_counter() - start
+
+
+class StageStats(object):
+    """Busy time and processed items of a pipeline stage, and depth samples of its output queue"""
+
+    def __init__(self, name, slots=1):
+        self.name = name
+        self.slots = slots
+        self.busy = 0.0
+        self.items = 0
+        self.depths = []
+
+    def put(self, q, entry, consumer=None):
+        """Put entry on q. With a consumer thread, stop waiting for space once it has exited"""
+        while True:
+            try:
+                q.put(entry, timeout=None if consumer is None else 1.0)
+                break
+            except queue.Full:
+                if not consumer.is_alive():
+                    raise RuntimeError(f"{consumer.name} stage stopped")
+        self.depths.append(q.qsize())
+
+    def report(self, elapsed):
+        utilization = 100.0 * self.busy / max(elapsed * self.slots, 1E-9)
+        line = f"  {self.name:<8} {self.items:>5} items  {self.busy:8.1f}s busy  {utilization:5.1f}% utilized"
+        if self.depths:
+            line += f"  output queue mean {np.mean(self.depths):.1f} max {max(self.depths)}"
+        print(line)
+
+
+def start_worker_pool(args):
+    """Sea-thru process pool. Workers come from a fork server (spawned where that is unavailable), so they
+    never inherit the threads, locks or CUDA state of the pipeline process. ProcessPoolExecutor takes no
+    mp_context before Python 3.7, so this sets the process-wide start method unless one was already chosen"""
+    if multiprocessing.get_start_method(allow_none=True) is None:
+        multiprocessing.set_start_method('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                         else 'spawn')
+    return concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+
+
+def process_directory_pipelined(image_files, encoder, depth_decoder, device, feed_width, feed_height, args,
+                                water_model=None):
+    """Streaming batch mode: decode (I/O thread) -> depth inference in batches of args.depth_batch_size (thread)
+    -> Sea-thru and denoise (process pool of args.workers) -> PNG encode (I/O thread), with bounded queues
+    between the stages. If a worker process dies, the pool is restarted and the images in flight resubmitted;
+    only an image that also kills a worker when retried on its own counts as failed.
+    Images are reported in input order; returns the number of failed images"""
+    decoded = queue.Queue(maxsize=args.queue_size)
+    predicted = queue.Queue(maxsize=args.queue_size)
+    enhancing = queue.Queue(maxsize=args.queue_size + args.workers)
+    stats = {name: StageStats(name, slots) for name, slots in
+             [('decode', 1), ('depth', 1), ('sea-thru', args.workers), ('encode', 1)]}
+    failed = [0]
+    inference = [0.0]
+    # current_pool[0] is replaced when a worker dies; in_flight maps idx -> [inputs, output path, future, pool]
+    pool_lock = threading.Lock()
+    current_pool = [start_worker_pool(args)]
+    isolating = [False]
+    in_flight = {}
+
+    def submit(idx, force=False):
+        """Submit an in-flight image to the current pool. While an image is retried on its own, others are held
+        back until resubmit_unfinished (call with pool_lock held)"""
+        record = in_flight[idx]
+        record[2], record[3] = None, None
+        if isolating[0] and not force:
+            return
+        record[3] = current_pool[0]
+        try:
+            record[2] = record[3].submit(enhance_in_worker, *record[0], record[1], (args, water_model))
+        except concurrent.futures.process.BrokenProcessPool:
+            pass
+
+    def restart_pool(broken):
+        """Replace the current pool if it is the broken one (call with pool_lock held)"""
+        if current_pool[0] is broken:
+            broken.shutdown(wait=False)
+            current_pool[0] = start_worker_pool(args)
+
+    def resubmit_unfinished(skip):
+        """Resubmit the images other than skip that were held back or left unfinished by a broken pool
+        (call with pool_lock held)"""
+        for idx, (_, _, future, pool) in sorted(in_flight.items()):
+            unfinished = future is None or not future.done() or future.exception() is not None
+            if idx != skip and pool is not current_pool[0] and unfinished:
+                submit(idx)
+
+    def future_result(idx):
+        """(pixels, log, error, seconds) of an image's future, raising BrokenProcessPool if its pool broke"""
+        with pool_lock:
+            future = in_flight[idx][2]
+        if future is None:
+            raise concurrent.futures.process.BrokenProcessPool('the process pool was broken on submission')
+        return future.result()
+
+    def enhance_result(idx, image_path):
+        """Result of an image. A dead worker breaks every future of its pool, so the image is retried on its
+        own in a new pool: if that breaks too it killed the worker and fails, otherwise the other images in
+        flight are resubmitted"""
+        with pool_lock:
+            pool = in_flight[idx][3]
+        try:
+            return future_result(idx)
+        except concurrent.futures.process.BrokenProcessPool:
+            pass
+        print(f"A worker process died, retrying {image_path} on its own")
+        with pool_lock:
+            restart_pool(pool)
+            isolating[0] = True
+            submit(idx, force=True)
+            pool = in_flight[idx][3]
+        try:
+            return future_result(idx)
+        except concurrent.futures.process.BrokenProcessPool:
+            with pool_lock:
+                restart_pool(pool)
+            return None, '', 'worker process died', 0.0
+        finally:
+            with pool_lock:
+                isolating[0] = False
+                resubmit_unfinished(idx)
+
+    def decode():
+        for idx, image_path in enumerate(image_files, 1):
+            start = time.perf_counter()
+            try:
+                entry = (idx, image_path, decode_image(image_path, args), None)
+            except Exception as e:
+                entry = (idx, image_path, None, str(e))
+            stats['decode'].busy += time.perf_counter() - start
+            stats['decode'].items += 1
+            stats['decode'].put(decoded, entry)
+        decoded.put(None)
+
+    def depth():
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < args.depth_batch_size:
+                entry = decoded.get()
+                if entry is None:
+                    done = True
+                    break
+                batch.append(list(entry))
+            frames = [entry for entry in batch if entry[3] is None]
+            if frames:
+                start = time.perf_counter()
+                try:
+                    disps = predict_disparities_cached([entry[2] for entry in frames], [entry[1] for entry in frames],
+                                                       encoder, depth_decoder, device, feed_width, feed_height, args)
+                except Exception as e:
+                    disps = [e] * len(frames)
+                inference[0] += time.perf_counter() - start
+                for entry, disp in zip(frames, disps):
+                    try:
+                        if isinstance(disp, Exception):
+                            raise disp
+                        entry[2] = prepare_image_and_depth(entry[2], disp, args)
+                    except Exception as e:
+                        entry[2], entry[3] = None, str(e)
+                stats['depth'].busy += time.perf_counter() - start
+                stats['depth'].items += len(frames)
+            for entry in batch:
+                stats['depth'].put(predicted, tuple(entry))
+        predicted.put(None)
+
+    def encode():
+        while True:
+            entry = enhancing.get()
+            if entry is None:
+                return
+            idx, image_path, error = entry
+            print(f"\n[{idx}/{len(image_files)}] Processing...")
+            print(f"\nProcessing: {image_path}")
+            if error is None:
+                try:
+                    pixels, log, error, busy = enhance_result(idx, image_path)
+                except Exception as e:
+                    error = str(e)
+                else:
+                    stats['sea-thru'].busy += busy
+                    stats['sea-thru'].items += 1
+                    print(log, end='')
+                with pool_lock:
+                    del in_flight[idx]
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    save_png(pixels, batch_output_path(image_path, args))
+                except Exception as e:
+                    error = str(e)
+                stats['encode'].busy += time.perf_counter() - start
+                stats['encode'].items += 1
+            if error is not None:
+                print(f"Error processing {image_path}: {error}")
+                failed[0] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=stage, name=stage.__name__, daemon=True) for stage in (decode, depth, encode)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            entry = predicted.get()
+            if entry is None:
+                break
+            idx, image_path, inputs, error = entry
+            if error is None:
+                with pool_lock:
+                    in_flight[idx] = [inputs, batch_output_path(image_path, args), None, None]
+                    submit(idx)
+            stats['sea-thru'].put(enhancing, (idx, image_path, error), consumer=threads[2])
+        stats['sea-thru'].put(enhancing, None, consumer=threads[2])
+        for thread in threads:
+            thread.join()
+    finally:
+        # shutdown has no cancel_futures before Python 3.9; cancel the images not started yet by hand
+        with pool_lock:
+            for record in in_flight.values():
+                if record[2] is not None:
+                    record[2].cancel()
+        current_pool[0].shutdown()
+    elapsed = time.perf_counter() - start
+
+    print(f"\nPipeline stages ({elapsed:.1f}s):")
+    for name in ('decode', 'depth', 'sea-thru', 'encode'):
+        stats[name].report(elapsed)
+    if inference[0] > 0:
+        print(f"Depth inference: {stats['depth'].items / inference[0]:.2f} images/s on {device} "
+              f"(batch size {args.depth_batch_size})")
+    return failed[0]
+
+
+def batch_output_path(image_path, args):
+    """Output file for an image of the input directory"""
+    return output_path_for(image_path, args.output_dir)
+
+
+def handle_request(header, payload, encoder, depth_decoder, device, feed_width, feed_height, args):
+    """Serve one request: 'ping', 'depth' (returns the depth map as .npy) or 'enhance' (returns a PNG).
+    The image is the payload bytes if there are any, else the file at header['path']"""
+    op = header.get('op', 'enhance')
+    if op == 'ping':
+        return {'ok': True}, b''
+    if op not in ('depth', 'enhance'):
+        raise ValueError(f"Unknown op '{op}'")
+    params = header.get('params', {})
+    unknown = set(params) - set(REQUEST_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown params: {', '.join(sorted(unknown))}")
+    request_args = argparse.Namespace(**vars(args))
+    vars(request_args).update(params)
+    raw = header.get('raw', args.raw)
+    img = decode_image(io.BytesIO(payload) if payload else header['path'], request_args, raw)
+    disp = predict_disparities_cached([img], [payload or header['path']], encoder, depth_decoder, device,
+                                      feed_width, feed_height, request_args)[0]
+    img, depths = prepare_image_and_depth(img, disp, request_args)
+    if op == 'depth':
+        return {'ok': True, 'format': 'npy'}, encode_array(depths)
+    pixels = enhance(img, depths, header.get('output', 'output.png'), request_args)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='png')
+    return {'ok': True, 'format': 'png'}, buffer.getvalue()
+
+
+def serve(encoder, depth_decoder, device, feed_width, feed_height, args):
+    """Keep the models loaded and answer requests on a pynng Rep0 socket until interrupted"""
+    with pynng.Rep0(listen=args.serve) as sock:
+        print(f"Serving on {args.serve}", flush=True)
+        while True:
+            message = sock.recv()
+            start = time.perf_counter()
+            log = io.StringIO()
+            header = {}
+            try:
+                header, payload = decode_message(message)
+                with contextlib.redirect_stdout(log):
+                    response, response_payload = handle_request(header, payload, encoder, depth_decoder, device,
+                                                                feed_width, feed_height, args)
+            except Exception as e:
+                response, response_payload = {'ok': False, 'error': str(e), 'log': log.getvalue()}, b''
+            response['seconds'] = time.perf_counter() - start
+            sock.send(encode_message(response, response_payload))
+            status = 'ok' if response['ok'] else f"error: {response['error']}"
+            print(f"{header.get('op', 'enhance')} {header.get('path', f'<{len(message)} bytes>')}: "
+                  f"{status} ({response['seconds']:.2f}s)", flush=True)
+
+
+def work(encoder, depth_decoder, device, feed_width, feed_height, args):
+    """Coordinator worker: pull jobs from args.jobs_address, run process_single_image on each and push the
+    outcome to args.results_address, until interrupted"""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    with pynng.Pull0(dial=args.jobs_address) as jobs, pynng.Push0(dial=args.results_address) as results:
+        print(f"Worker {worker_id} pulling jobs from {args.jobs_address}", flush=True)
+        while True:
+            job, _ = decode_message(jobs.recv())
+            start = time.perf_counter()
+            result = {'id': job['id'], 'attempt': job['attempt'], 'worker': worker_id, 'ok': True}
+            try:
+                os.makedirs(os.path.dirname(job['output']) or '.', exist_ok=True)
+                process_single_image(job['path'], job['output'], encoder, depth_decoder, device,
+                                     feed_width, feed_height, args)
+            except Exception as e:
+                print(f"Error processing {job['path']}: {e}", flush=True)
+                result.update(ok=False, error=str(e))
+            result['seconds'] = time.perf_counter() - start
+            results.send(encode_message(result))
+
+
+def load_depth_model(args):
+    """Load the monodepth encoder and decoder; returns them with the device and their input size"""
     assert args.model_name is not None, \
         "You must specify the --model_name parameter; see README.md for an example"
 
@@ -109,6 +534,20 @@ def run(args):
 
     depth_decoder.to(device)
     depth_decoder.eval()
+    return encoder, depth_decoder, device, feed_width, feed_height
+
+
+def run(args):
+    """Function to predict for a single image or folder of images
+    """
+    encoder, depth_decoder, device, feed_width, feed_height = load_depth_model(args)
+
+    if args.serve:
+        serve(encoder, depth_decoder, device, feed_width, feed_height, args)
+        return
+    if args.worker:
+        work(encoder, depth_decoder, device, feed_width, feed_height, args)
+        return
 
     # Check if input is directory or single image
     if args.input_dir:
@@ -118,36 +557,24 @@ def run(args):
             print(f"Created output directory: {args.output_dir}")
         
         # Get all image files
-        image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.JPG', '*.JPEG', '*.PNG']
-        if args.raw:
-            image_extensions.extend(['*.raw', '*.RAW', '*.dng', '*.DNG'])
-        
-        image_files = []
-        for ext in image_extensions:
-            image_files.extend(glob.glob(os.path.join(args.input_dir, ext)))
-        
+        image_files = find_images(args.input_dir, args.raw)
+
         if not image_files:
             print(f"No images found in {args.input_dir}")
             return
         
         print(f"Found {len(image_files)} images to process")
+
+        water_model = None
+        if args.dive_model:
+            water_model = calibrate_dive_model(image_files, encoder, depth_decoder, device, feed_width, feed_height, args)
+            print(f"Saved dive model to {save_model_sidecar(water_model, os.path.join(args.output_dir, 'dive_model.json'))}")
         
-        # Process each image
-        for idx, image_path in enumerate(image_files, 1):
-            print(f"\n[{idx}/{len(image_files)}] Processing...")
-            
-            # Generate output filename
-            base_name = os.path.basename(image_path)
-            name_without_ext = os.path.splitext(base_name)[0]
-            output_path = os.path.join(args.output_dir, f"{name_without_ext}_seathru.png")
-            
-            try:
-                process_single_image(image_path, output_path, encoder, depth_decoder, 
-                                   device, feed_width, feed_height, args)
-            except Exception as e:
-                print(f"Error processing {image_path}: {e}")
-                continue
-        
+        failed = process_directory_pipelined(image_files, encoder, depth_decoder, device, feed_width,
+                                             feed_height, args, water_model)
+        if failed:
+            print(f"\n{failed} of {len(image_files)} images failed")
+
         print(f"\nBatch processing complete! Processed {len(image_files)} images")
         print(f"Output saved to: {args.output_dir}")
     
@@ -182,11 +609,51 @@ if __name__ == '__main__':
     parser.add_argument('--model-name', type=str, default="mono_1024x320",
                         help='monodepth model name')
     parser.add_argument('--output-graphs', action='store_true', help='Output graphs')
+    parser.add_argument('--illumination-solver', default='closed_form', choices=['closed_form', 'segmented', 'loop'],
+                        help='Solver for the local space average colour')
+    parser.add_argument('--fit-agree', type=int, default=None,
+                        help='Fit backscatter restarts this many at a time and stop once this many agree on the best '
+                             'loss (faster, but may pick different coefficients than fitting all restarts)')
+    parser.add_argument('--attenuation-samples', type=int, default=None,
+                        help='Fit wideband attenuation on at most this many depth-stratified pixels')
+    parser.add_argument('--smoothing', default='bilateral', choices=sorted(SMOOTHING_BACKENDS),
+                        help='Edge-preserving smoothing backend')
+    parser.add_argument('--float32', action='store_true', help='Run the pipeline in float32 with preallocated buffers')
+    parser.add_argument('--estimate-size', type=int, default=None,
+                        help='Estimate parameters on a copy downsampled to this size and apply them at full size')
+    parser.add_argument('--lut-bins', type=int, default=None,
+                        help='Apply backscatter and attenuation through depth lookup tables with this many bins')
+    parser.add_argument('--serve', nargs='?', const=DEFAULT_ADDRESS, default=None, metavar='ADDRESS',
+                        help=f'Keep the models loaded and serve requests from seathru-client.py on this pynng address '
+                             f'(default {DEFAULT_ADDRESS})')
+    parser.add_argument('--worker', action='store_true',
+                        help='Process jobs from seathru-coordinator.py (see --jobs-address and --results-address)')
+    parser.add_argument('--jobs-address', default=DEFAULT_JOBS_ADDRESS, help='Coordinator address to pull jobs from')
+    parser.add_argument('--results-address', default=DEFAULT_RESULTS_ADDRESS,
+                        help='Coordinator address to push results to')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Batch mode: processes running the Sea-thru stages in parallel')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='Batch mode: capacity of the queues between pipeline stages')
+    parser.add_argument('--depth-batch-size', type=int, default=4,
+                        help='Batch mode: frames stacked into one monodepth forward pass')
+    parser.add_argument('--dive-model', action='store_true',
+                        help='Batch mode: fit one water model from --calibration-frames frames and apply it to every image')
+    parser.add_argument('--calibration-frames', type=int, default=5,
+                        help='Frames sampled across the directory to calibrate the --dive-model')
+    parser.add_argument('--depth-cache', default=None, metavar='DIR',
+                        help='Cache predicted depth maps in this directory, keyed by image content, model and size')
+    parser.add_argument('--depth-cache-size', type=float, default=1024,
+                        help='Size limit of the --depth-cache in MB; least recently used entries are evicted')
+    parser.add_argument('--save-sidecar', action='store_true',
+                        help='Save the fitted model next to each output (.json + .npz)')
+    parser.add_argument('--sidecar', default=None,
+                        help='Apply-only: sidecar file to use for every image, or directory of per-image sidecars')
     parser.add_argument('--raw', action='store_true', help='RAW image')
     parser.add_argument('--no-cuda', action='store_true', help='Force CPU processing')
     args = parser.parse_args()
     
     # Validate arguments
-    if not args.image and not args.input_dir:
-        parser.error('Must specify either --image for single image or --input-dir for batch processing')
+    if not args.image and not args.input_dir and not args.serve and not args.worker:
+        parser.error('Must specify either --image for single image, --input-dir for batch processing, --serve or --worker')
     run(args)
@@ -1,15 +1,23 @@
 import collections
+import json
+import os
+import shutil
+import struct
+import tempfile
+import zlib
 import sys
+import time
 import argparse
 import numpy as np
 import sklearn as sk
 import scipy as sp
+import scipy.ndimage
 import scipy.optimize
 import scipy.stats
-import math
 from PIL import Image
 import rawpy
 from skimage import exposure
+from skimage.transform import resize
 from skimage.restoration import denoise_bilateral, denoise_tv_chambolle, estimate_sigma
 from skimage.morphology import closing, opening, erosion, dilation, disk, diamond, square
 import matplotlib
@@ -29,74 +37,267 @@ def find_backscatter_estimation_points(img, depths, num_bins=10, fraction=0.01,
     z_max, z_min = np.max(depths), np.min(depths)
     min_depth = z_min + (min_depth_percent * (z_max - z_min))
     z_ranges = np.linspace(z_min, z_max, num_bins + 1)
-    img_norms = np.mean(img, axis=2)
-    points_r = []
-    points_g = []
-    points_b = []
-    for i in range(len(z_ranges) - 1):
-        a, b = z_ranges[i], z_ranges[i+1]
-        locs = np.where(np.logical_and(depths > min_depth, np.logical_and(depths >= a, depths <= b)))
-        norms_in_range, px_in_range, depths_in_range = img_norms[locs], img[locs], depths[locs]
-        arr = sorted(zip(norms_in_range, px_in_range, depths_in_range), key=lambda x: x[0])
-        points = arr[:min(math.ceil(fraction * len(arr)), max_vals)]
-        points_r.extend([(z, p[0]) for n, p, z in points])
-        points_g.extend([(z, p[1]) for n, p, z in points])
-        points_b.extend([(z, p[2]) for n, p, z in points])
-    return np.array(points_r), np.array(points_g), np.array(points_b)
+    flat_depths = depths.ravel()
+    px = np.flatnonzero(flat_depths > min_depth)
+    px_depths = flat_depths[px]
+    bins = np.clip(np.searchsorted(z_ranges, px_depths, side='right') - 1, 0, num_bins - 1)
+    # ranges are closed on both ends, so depths on an inner edge belong to both neighbouring bins
+    on_edge = np.logical_and(bins > 0, px_depths == z_ranges[bins])
+    px = np.concatenate([px, px[on_edge]])
+    bins = np.concatenate([bins, bins[on_edge] - 1])
+    flat_img = img.reshape(-1, img.shape[2])
+    norms = np.mean(flat_img[px], axis=1)
+    order = np.lexsort((px, norms, bins))
+    px, bins = px[order], bins[order]
+    bin_sizes = np.bincount(bins, minlength=num_bins)
+    bin_starts = np.cumsum(bin_sizes) - bin_sizes
+    keep = np.minimum(np.ceil(fraction * bin_sizes), max_vals)
+    px = px[(np.arange(len(px)) - bin_starts[bins]) < keep[bins]]
+    points = [np.stack([flat_depths[px], flat_img[px, c]], axis=1) for c in range(3)]
+    return points[0], points[1], points[2]
+
+'''
+Backscatter model and its analytic Jacobian with respect to
+(B_inf, beta_B, J_prime, beta_D_prime)
+'''
+def backscatter_model(depths, B_inf, beta_B, J_prime, beta_D_prime):
+    val = (B_inf * (1 - np.exp(-1 * beta_B * depths))) + (J_prime * np.exp(-1 * beta_D_prime * depths))
+    return val
+
+def backscatter_model_jacobian(depths, B_inf, beta_B, J_prime, beta_D_prime):
+    exp_B = np.exp(-1 * beta_B * depths)
+    exp_D = np.exp(-1 * beta_D_prime * depths)
+    return np.stack([1 - exp_B, B_inf * depths * exp_B, exp_D, -1 * J_prime * depths * exp_D], axis=-1)
+
+'''
+Least-squares fits of the backscatter model from many starting
+points at once: Levenberg-Marquardt steps projected onto the
+bounds, vectorized over the starts so that a restart costs a
+few array operations rather than a curve_fit call. A start
+stops once a step lowers its cost by less than ftol relative
+to it, moves it by less than xtol relative to its coefficients
+(as in curve_fit), or no step is accepted any more. Returns the
+fitted coefficients, one row per start
+'''
+def fit_backscatter_batch(B_depths, B_vals, starts, bounds, max_iters=100, ftol=1E-8, xtol=1E-8):
+    lower, upper = (np.asarray(b, dtype=np.float64) for b in bounds)
+    coefs = np.clip(np.array(starts, dtype=np.float64), lower, upper)
+    def residuals(p):
+        return backscatter_model(B_depths, *p.T[:, :, None]) - B_vals
+    res = residuals(coefs)
+    cost = np.sum(res ** 2, axis=1)
+    damping = np.full(len(coefs), 1E-3)
+    active = np.ones(len(coefs), dtype=bool)
+    for _ in range(max_iters):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        J = backscatter_model_jacobian(B_depths, *coefs[idx].T[:, :, None])
+        Jt = J.transpose(0, 2, 1)
+        JtJ = Jt @ J
+        grad = (Jt @ res[idx][:, :, None])[:, :, 0]
+        # Marquardt scaling of the damping; the floor keeps the system positive definite
+        scaling = np.maximum(np.diagonal(JtJ, axis1=1, axis2=2), 1E-9)
+        system = JtJ + (damping[idx, None] * scaling)[:, :, None] * np.eye(4)
+        step = np.linalg.solve(system, -grad[:, :, None])[:, :, 0]
+        trial = np.clip(coefs[idx] + step, lower, upper)
+        trial_res = residuals(trial)
+        trial_cost = np.sum(trial_res ** 2, axis=1)
+        better = trial_cost < cost[idx]
+        step_norm = np.linalg.norm(trial - coefs[idx], axis=1)
+        converged = (step_norm <= xtol * (xtol + np.linalg.norm(coefs[idx], axis=1))) | \
+            (better & (cost[idx] - trial_cost <= ftol * cost[idx]))
+        accepted = idx[better]
+        coefs[accepted], res[accepted], cost[accepted] = trial[better], trial_res[better], trial_cost[better]
+        damping[idx] = np.where(better, damping[idx] / 3, damping[idx] * 2)
+        active[idx[converged | (damping[idx] > 1E10)]] = False
+    return coefs
 
 '''
 Estimates coefficients for the backscatter curve
-based on the backscatter point values and their depths
+based on the backscatter point values and their depths.
+All restarts are fitted together (see fit_backscatter_batch)
+and the one with the lowest mean absolute error wins. With
+`agree` set, restarts are fitted `agree` at a time and fitting
+stops once that many have reached the best loss (within
+agree_tol). Only losses are compared, so the restarts that
+stop it may sit at different coefficients than the full run
+would have chosen: the opt-in trades that for fewer fits
 '''
-def find_backscatter_values(B_pts, depths, restarts=10, max_mean_loss_fraction=0.1):
+def find_backscatter_values(B_pts, depths, restarts=10, max_mean_loss_fraction=0.1, agree=None, agree_tol=1E-6):
     B_vals, B_depths = B_pts[:, 1], B_pts[:, 0]
     z_max, z_min = np.max(depths), np.min(depths)
     max_mean_loss = max_mean_loss_fraction * (z_max - z_min)
     coefs = None
     best_loss = np.inf
-    def estimate(depths, B_inf, beta_B, J_prime, beta_D_prime):
-        val = (B_inf * (1 - np.exp(-1 * beta_B * depths))) + (J_prime * np.exp(-1 * beta_D_prime * depths))
-        return val
+    num_agreeing = 0
     def loss(B_inf, beta_B, J_prime, beta_D_prime):
-        val = np.mean(np.abs(B_vals - estimate(B_depths, B_inf, beta_B, J_prime, beta_D_prime)))
+        val = np.mean(np.abs(B_vals - backscatter_model(B_depths, B_inf, beta_B, J_prime, beta_D_prime)))
         return val
     bounds_lower = [0,0,0,0]
     bounds_upper = [1,5,1,5]
-    for _ in range(restarts):
-        try:
-            optp, pcov = sp.optimize.curve_fit(
-                f=estimate,
-                xdata=B_depths,
-                ydata=B_vals,
-                p0=np.random.random(4) * bounds_upper,
-                bounds=(bounds_lower, bounds_upper),
-            )
+    starts = np.random.random((restarts, 4)) * bounds_upper
+    batch_size = restarts if agree is None else max(1, agree)
+    for batch in range(0, restarts, batch_size):
+        for optp in fit_backscatter_batch(B_depths, B_vals, starts[batch:batch + batch_size], (bounds_lower, bounds_upper)):
             l = loss(*optp)
+            if not np.isfinite(l):
+                continue
+            if l < best_loss - (agree_tol * best_loss):
+                num_agreeing = 0
+            if l <= best_loss + (agree_tol * best_loss):
+                num_agreeing += 1
             if l < best_loss:
                 best_loss = l
                 coefs = optp
-        except RuntimeError as re:
-            print(re, file=sys.stderr)
+        if agree is not None and num_agreeing >= agree:
+            break
     if best_loss > max_mean_loss:
         print('Warning: could not find accurate reconstruction. Switching to linear model.', flush=True)
         slope, intercept, r_value, p_value, std_err = sp.stats.linregress(B_depths, B_vals)
         BD = (slope * depths) + intercept
         return BD, np.array([slope, intercept])
-    return estimate(depths, *coefs), coefs
+    return backscatter_model(depths, *coefs), coefs
 
 '''
-Estimate illumination map from local color space averaging
+Edge-preserving guided filter (He et al.) with the image as
+its own guide. The box means come from uniform_filter, which
+uses running sums, so the cost does not depend on radius. eps
+defaults to the image variance, matching the colour sigma
+that denoise_bilateral picks by default
 '''
-def estimate_illumination(img, B, neighborhood_map, num_neighborhoods, p=0.5, f=2.0, max_iters=100, tol=1E-5):
-    D = img - B
-    avg_cs = np.zeros_like(img)
+def guided_filter(img, radius=2, eps=None):
+    if eps is None:
+        eps = np.var(img)
+    size = (2 * radius) + 1
+    mean_I = sp.ndimage.uniform_filter(img, size)
+    var_I = sp.ndimage.uniform_filter(img * img, size) - (mean_I * mean_I)
+    a = var_I / (var_I + eps + 1E-12)
+    b = mean_I - (a * mean_I)
+    res = (sp.ndimage.uniform_filter(a, size) * img) + sp.ndimage.uniform_filter(b, size)
+    return np.clip(res, np.min(img), np.max(img))
+
+SMOOTHING_BACKENDS = {
+    'bilateral': denoise_bilateral,
+    'guided': guided_filter,
+}
+
+'''
+Edge-preserving smoothing of a single channel with the
+selected backend, reporting the time taken by each call
+'''
+def smooth(img, backend='bilateral'):
+    start = time.time()
+    res = SMOOTHING_BACKENDS[backend](img)
+    print('Smoothing ({}, {}x{}) took {:.3f}s'.format(backend, img.shape[1], img.shape[0], time.time() - start), flush=True)
+    return res
+
+'''
+Flat view of a neighborhood map shared by the illumination
+solvers: the label of every pixel, the size of every
+neighborhood, a mask of the pixels that take part in local
+averaging (neighborhoods 1..num_neighborhoods with more than
+one pixel) and those pixels grouped by neighborhood in CSR
+form (pixel indices in order, segment offsets in starts)
+'''
+NeighborhoodIndex = collections.namedtuple('NeighborhoodIndex', ['labels', 'sizes', 'active', 'order', 'starts'])
+
+def build_neighborhood_index(neighborhood_map, num_neighborhoods):
+    labels = neighborhood_map.ravel().astype(np.intp)
+    sizes = np.bincount(labels, minlength=num_neighborhoods + 1)
+    active = np.logical_and(np.logical_and(labels != 0, labels <= num_neighborhoods), sizes[labels] > 1)
+    order = np.flatnonzero(active)
+    order = order[np.argsort(labels[order], kind='stable')]
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_labels[1:] != sorted_labels[:-1]])) if len(order) > 0 else order
+    return NeighborhoodIndex(labels, sizes, active, order, starts)
+
+'''
+Local space average colour computed with one segmented
+reduction (np.bincount) over all neighborhoods per iteration.
+D is (pixels, channels); channels are iterated together and
+each stops on its own tol check. Returns the averages and the
+iteration count of every channel
+'''
+def local_space_average(D, index, p=0.5, max_iters=100, tol=1E-5):
+    denom = np.maximum(index.sizes - 1, 1)[index.labels]
+    avg_cs = np.zeros_like(D)
+    iters = np.zeros(D.shape[1], dtype=int)
+    done = np.zeros(D.shape[1], dtype=bool)
+    for _ in range(max_iters):
+        if np.all(done):
+            break
+        for c in np.flatnonzero(~done):
+            iters[c] += 1
+            sums = np.bincount(index.labels, weights=avg_cs[:, c], minlength=len(index.sizes))
+            avg_cs_prime = np.where(index.active, (sums[index.labels] - avg_cs[:, c]) / denom, 0)
+            new_avg_cs = (D[:, c] * p) + (avg_cs_prime * (1 - p))
+            if np.max(np.abs(avg_cs[:, c] - new_avg_cs)) < tol:
+                done[c] = True
+            else:
+                avg_cs[:, c] = new_avg_cs
+    return avg_cs, [int(i) for i in iters]
+
+'''
+Closed form of the local space average iteration. Within a
+neighborhood of size n the mean follows m' = p*m_D + (1-p)*m
+and each deviation from it follows e' = p*e_D + r*e with
+r = -(1-p)/(n-1), so the k-th iterate is a geometric sum.
+The tol check only needs the per-neighborhood extreme
+deviations, which gives the same stopping pass as the loop
+without touching the pixels again. D is (pixels, channels);
+returns the averages and the iteration count of every channel
+'''
+def local_space_average_closed_form(D, index, p=0.5, max_iters=100, tol=1E-5):
+    labels, order, starts = index.labels, index.order, index.starts
+    n = index.sizes.astype(np.float64)
+    r = -(1 - p) / np.maximum(n - 1, 1)
+    order_labels = labels[order]
+    r_px = r[order_labels]
+    region_labels = order_labels[starts]
+    region_r = r[region_labels]
+    inactive = ~index.active
+    avg_cs = np.zeros_like(D)
+    iters = []
+    for c in range(D.shape[1]):
+        mean_D = np.bincount(labels, weights=D[:, c], minlength=len(n)) / np.maximum(n, 1)
+        dev_D = D[order, c] - mean_D[order_labels]
+        # a_{k+1} - a_k = p * (m_D * (1-p)^k + e_D * r^k), which is extreme at the extreme deviations
+        dev_max = np.maximum.reduceat(dev_D, starts) if len(order) > 0 else dev_D
+        dev_min = np.minimum.reduceat(dev_D, starts) if len(order) > 0 else dev_D
+        region_mean = mean_D[region_labels]
+        inactive_step = p * np.max(np.abs(D[inactive, c])) if np.any(inactive) else 0.0
+        k = max_iters
+        iters.append(max_iters)
+        for i in range(max_iters):
+            mean_step = region_mean * (1 - p) ** i
+            step = p * np.max(np.abs(np.concatenate([mean_step + (dev_max * region_r ** i), mean_step + (dev_min * region_r ** i), [0.0]])))
+            if i == 0:
+                step = max(step, inactive_step)
+            if step < tol:
+                k, iters[c] = i, i + 1
+                break
+        if k > 0:
+            avg_cs[:, c] = D[:, c] * p
+        avg_cs[order, c] = (mean_D[order_labels] * (1 - (1 - p) ** k)) + (p * dev_D * (1 - r_px ** k) / (1 - r_px))
+    return avg_cs, iters
+
+'''
+Local space average colour with one gather/scatter per
+neighborhood per iteration. Reference implementation
+for local_space_average
+'''
+def local_space_average_loop(D, neighborhood_map, num_neighborhoods, p=0.5, max_iters=100, tol=1E-5):
+    avg_cs = np.zeros_like(D)
     avg_cs_prime = np.copy(avg_cs)
+    iters = 0
     sizes = np.zeros(num_neighborhoods)
     locs_list = [None] * num_neighborhoods
     for label in range(1, num_neighborhoods + 1):
         locs_list[label - 1] = np.where(neighborhood_map == label)
         sizes[label - 1] = np.size(locs_list[label - 1][0])
     for _ in range(max_iters):
+        iters += 1
         for label in range(1, num_neighborhoods + 1):
             locs = locs_list[label - 1]
             size = sizes[label - 1] - 1
@@ -105,16 +306,52 @@ def estimate_illumination(img, B, neighborhood_map, num_neighborhoods, p=0.5, f=
         if(np.max(np.abs(avg_cs - new_avg_cs)) < tol):
             break
         avg_cs = new_avg_cs
-    return f * denoise_bilateral(np.maximum(0, avg_cs))
+    return avg_cs, iters
+
+'''
+Estimate illumination maps for every channel of an H x W x C
+image from local color space averaging. The neighborhood index
+is built once and the channels are solved together. solver is
+one of 'closed_form', 'segmented' or 'loop'; with return_iters
+the number of averaging passes per channel is also returned
+'''
+def estimate_illumination_multichannel(img, B, neighborhood_map, num_neighborhoods, p=0.5, f=2.0, max_iters=100, tol=1E-5, solver='closed_form', return_iters=False, smoothing='bilateral'):
+    D = img - B
+    if solver == 'loop':
+        results = [local_space_average_loop(D[:, :, c], neighborhood_map, num_neighborhoods, p, max_iters, tol) for c in range(D.shape[2])]
+        avg_cs = np.stack([avg for avg, _ in results], axis=2)
+        iters = [i for _, i in results]
+    else:
+        index = build_neighborhood_index(neighborhood_map, num_neighborhoods)
+        solve = local_space_average_closed_form if solver == 'closed_form' else local_space_average
+        avg_cs, iters = solve(D.reshape(-1, D.shape[2]), index, p, max_iters, tol)
+        avg_cs = avg_cs.reshape(D.shape)
+    del D
+    illum = np.empty(avg_cs.shape, dtype=img.dtype)
+    for c in range(avg_cs.shape[2]):
+        illum[:, :, c] = smooth(np.maximum(0, avg_cs[:, :, c]), smoothing)
+    illum *= f
+    if return_iters:
+        return illum, iters
+    return illum
+
+'''
+Estimate illumination map from local color space averaging
+'''
+def estimate_illumination(img, B, neighborhood_map, num_neighborhoods, p=0.5, f=2.0, max_iters=100, tol=1E-5, solver='closed_form', return_iters=False, smoothing='bilateral'):
+    illum, iters = estimate_illumination_multichannel(img[:, :, None], np.expand_dims(B, axis=2), neighborhood_map, num_neighborhoods, p, f, max_iters, tol, solver, return_iters=True, smoothing=smoothing)
+    if return_iters:
+        return illum[:, :, 0], iters[0]
+    return illum[:, :, 0]
 
 '''
 Estimate values for beta_D
 '''
-def estimate_wideband_attentuation(depths, illum, radius = 6, max_val = 10.0):
+def estimate_wideband_attentuation(depths, illum, radius = 6, max_val = 10.0, smoothing='bilateral'):
     eps = 1E-8
     BD = np.minimum(max_val, -np.log(illum + eps) / (np.maximum(0, depths) + eps))
     mask = np.where(np.logical_and(depths > eps, illum > eps), 1, 0)
-    refined_attenuations = denoise_bilateral(closing(np.maximum(0, BD * mask), disk(radius)))
+    refined_attenuations = smooth(closing(np.maximum(0, BD * mask), disk(radius)), smoothing)
     return refined_attenuations, []
 
 '''
@@ -123,38 +360,84 @@ Calculate the values of beta_D for an image from the depths, illuminations, and
 def calculate_beta_D(depths, a, b, c, d):
     return (a * np.exp(b * depths)) + (c * np.exp(d * depths))
 
+'''
+Jacobian of calculate_beta_D with respect to (a, b, c, d)
+'''
+def calculate_beta_D_jacobian(depths, a, b, c, d):
+    exp_b = np.exp(b * depths)
+    exp_d = np.exp(d * depths)
+    return np.stack([exp_b, a * depths * exp_b, exp_d, c * depths * exp_d], axis=1)
+
+'''
+Picks at most max_samples of the locations, stratified by depth:
+the depth range is cut into bins, every bin keeps its share of the
+samples and those are taken evenly spaced from the bin's locations.
+Grouping by bin is a radix sort on small integers, so no sort of
+the depths themselves is needed
+'''
+def stratified_depth_sample(locs, depths, max_samples=None, bins=1024):
+    if max_samples is None or len(locs[0]) <= max_samples:
+        return locs
+    z = depths[locs]
+    bins = min(bins, max_samples)
+    z_min, z_max = np.min(z), np.max(z)
+    scale = (bins - 1) / (z_max - z_min) if z_max > z_min else 0
+    bin_idx = ((z - z_min) * scale).astype(np.uint16)
+    counts = np.bincount(bin_idx, minlength=bins)
+    # every bin's share of max_samples, rounded down with the remainder going to the largest fractions
+    share = counts * (max_samples / len(z))
+    quota = np.floor(share).astype(np.intp)
+    remainder = max_samples - np.sum(quota)
+    if remainder > 0:
+        quota[np.argpartition(quota - share, remainder - 1)[:remainder]] += 1
+    members = np.argsort(bin_idx, kind='stable')
+    starts = np.cumsum(counts) - counts
+    picks = np.concatenate([
+        members[start + (np.arange(k) * count) // k]
+        for start, count, k in zip(starts, counts, quota) if k > 0])
+    return tuple(loc[picks] for loc in locs)
+
 
+'''
+Thins (X, Y) samples for curve fitting. Sorted by X, the
+samples are cut into consecutive groups that each span at
+least radius_fraction of the X range, and the median-Y
+sample of every group is kept along with the first sample
+'''
 def filter_data(X, Y, radius_fraction=0.01):
-    idxs = np.argsort(X)
+    idxs = np.argsort(X, kind='stable')
     X_s = X[idxs]
     Y_s = Y[idxs]
     x_max, x_min = np.max(X), np.min(X)
     radius = (radius_fraction * (x_max - x_min))
-    ds = np.cumsum(X_s - np.roll(X_s, (1,)))
-    dX = [X_s[0]]
-    dY = [Y_s[0]]
-    tempX = []
-    tempY = []
+    if radius <= 0:
+        return X_s, Y_s
+    # group ends: the first sample at least radius past the previous end
+    ends = []
     pos = 0
-    for i in range(1, ds.shape[0]):
-        if ds[i] - ds[pos] >= radius:
-            tempX.append(X_s[i])
-            tempY.append(Y_s[i])
-            idxs = np.argsort(tempY)
-            med_idx = len(idxs) // 2
-            dX.append(tempX[med_idx])
-            dY.append(tempY[med_idx])
-            pos = i
-        else:
-            tempX.append(X_s[i])
-            tempY.append(Y_s[i])
-    return np.array(dX), np.array(dY)
+    while True:
+        pos = max(np.searchsorted(X_s, X_s[pos] + radius, side='left'), pos + 1)
+        if pos >= len(X_s):
+            break
+        ends.append(pos)
+    ends = np.array(ends, dtype=np.intp)
+    if len(ends) == 0:
+        return X_s[:1], Y_s[:1]
+    group_ids = np.zeros(len(X_s), dtype=np.intp)
+    group_ids[ends[:-1] + 1] = 1
+    group_ids = np.cumsum(group_ids)[1:ends[-1] + 1]
+    order = np.lexsort((Y_s[1:ends[-1] + 1], group_ids)) + 1
+    group_starts = np.concatenate([[0], ends[:-1]])
+    medians = order[group_starts + ((ends - group_starts) // 2)]
+    return np.concatenate([X_s[:1], X_s[medians]]), np.concatenate([Y_s[:1], Y_s[medians]])
 
 '''
 Estimate coefficients for the 2-term exponential
-describing the wideband attenuation
+describing the wideband attenuation. With max_samples
+the fit and its loss only use a depth-stratified subset
+of that many pixels
 '''
-def refine_wideband_attentuation(depths, illum, estimation, restarts=10, min_depth_fraction = 0.1, max_mean_loss_fraction=np.inf, l=1.0, radius_fraction=0.01):
+def refine_wideband_attentuation(depths, illum, estimation, restarts=10, min_depth_fraction = 0.1, max_mean_loss_fraction=np.inf, l=1.0, radius_fraction=0.01, max_samples=None):
     eps = 1E-8
     z_max, z_min = np.max(depths), np.min(depths)
     min_depth = z_min + (min_depth_fraction * (z_max - z_min))
@@ -162,6 +445,7 @@ def refine_wideband_attentuation(depths, illum, estimation, restarts=10, min_dep
     coefs = None
     best_loss = np.inf
     locs = np.where(np.logical_and(illum > 0, np.logical_and(depths > min_depth, estimation > eps)))
+    locs = stratified_depth_sample(locs, depths, max_samples)
     def calculate_reconstructed_depths(depths, illum, a, b, c, d):
         eps = 1E-5
         res = -np.log(illum + eps) / (calculate_beta_D(depths, a, b, c, d) + eps)
@@ -176,7 +460,8 @@ def refine_wideband_attentuation(depths, illum, estimation, restarts=10, min_dep
                 xdata=dX,
                 ydata=dY,
                 p0=np.abs(np.random.random(4)) * np.array([1., -1., 1., -1.]),
-                bounds=([0, -100, 0, -100], [100, 0, 100, 0]))
+                bounds=([0, -100, 0, -100], [100, 0, 100, 0]),
+                jac=calculate_beta_D_jacobian)
             L = loss(*optp)
             if L < best_loss:
                 best_loss = L
@@ -199,14 +484,88 @@ def refine_wideband_attentuation(depths, illum, estimation, restarts=10, min_dep
 
 '''
 Reconstruct the scene and globally white balance
-based the Gray World Hypothesis
+based the Gray World Hypothesis. out may be a
+preallocated buffer (e.g. beta_D once it is no
+longer needed) that receives the result
 '''
-def recover_image(img, depths, B, beta_D, nmap):
-    res = (img - B) * np.exp(beta_D * np.expand_dims(depths, axis=2))
-    res = np.maximum(0.0, np.minimum(1.0, res))
-    res[nmap == 0] = 0
-    res = scale(wbalance_no_red_10p(res))
-    res[nmap == 0] = img[nmap == 0]
+def recover_image(img, depths, B, beta_D, nmap, out=None):
+    res = np.multiply(beta_D, np.expand_dims(depths, axis=2), out=out)
+    np.exp(res, out=res)
+    for c in range(res.shape[2]):
+        res[:, :, c] *= img[:, :, c] - B[:, :, c]
+    return finish_recovery(res, img, nmap)
+
+'''
+Depth-indexed lookup tables for a fitted model: per channel,
+gain holds exp(beta_D(z) * z) and offset holds
+B(z) * exp(beta_D(z) * z) at bins depths evenly spaced over
+[z0, z0 + (bins - 1) * step], and are interpolated linearly
+in between, so that recovery is img * gain - offset
+'''
+DepthLUT = collections.namedtuple('DepthLUT', ['z0', 'step', 'gain', 'offset'])
+
+def build_depth_lut(model, depth_range, bins, l=1.0, dtype=np.float64):
+    z0, z1 = float(depth_range[0]), float(depth_range[1])
+    step = (z1 - z0) / (bins - 1) if bins > 1 and z1 > z0 else 1.0
+    z = z0 + step * np.arange(bins)
+    gain = np.empty((3, bins), dtype=dtype)
+    offset = np.empty((3, bins), dtype=dtype)
+    for c in range(3):
+        gain[c] = np.exp(evaluate_beta_D(z, model['attenuation'][c], l) * z)
+        offset[c] = evaluate_backscatter(z, model['backscatter'][c]) * gain[c]
+    return DepthLUT(z0, step, gain, offset)
+
+'''
+Bin index of every depth in a depth LUT and its fractional
+position towards the next bin
+'''
+def depth_lut_position(lut, depths):
+    pos = np.subtract(depths, lut.z0, dtype=np.float32)
+    pos *= np.float32(1.0 / lut.step)
+    np.clip(pos, 0, lut.gain.shape[1] - 1, out=pos)
+    idx = pos.astype(np.intp)
+    pos -= idx
+    return idx, pos
+
+'''
+Unscaled recovery through a depth LUT: per channel, gathers
+of the tables and their slopes and a few multiply-adds. The
+interpolation error falls with the square of the bin width
+'''
+def apply_depth_lut(img, depths, lut, out=None):
+    idx, frac = depth_lut_position(lut, depths)
+    # slope to the next bin; the last bin has none, and is only reached exactly
+    gain_slope = np.diff(lut.gain, axis=1, append=lut.gain[:, -1:])
+    offset_slope = np.diff(lut.offset, axis=1, append=lut.offset[:, -1:])
+    res = np.empty(img.shape, dtype=lut.gain.dtype) if out is None else out
+    for c in range(3):
+        gain = gain_slope[c][idx]
+        gain *= frac
+        gain += lut.gain[c][idx]
+        offset = offset_slope[c][idx]
+        offset *= frac
+        offset += lut.offset[c][idx]
+        np.multiply(img[:, :, c], gain, out=res[:, :, c])
+        res[:, :, c] -= offset
+    return res
+
+'''
+Reconstructs the scene with a depth LUT instead of full
+resolution B and beta_D maps (see recover_image)
+'''
+def recover_image_lut(img, depths, lut, nmap, out=None):
+    return finish_recovery(apply_depth_lut(img, depths, lut, out=out), img, nmap)
+
+'''
+Clips the recovered scene, white balances and scales it and
+keeps the original pixels outside the neighborhood map
+'''
+def finish_recovery(res, img, nmap):
+    np.clip(res, 0.0, 1.0, out=res)
+    background = nmap == 0
+    res[background] = 0
+    res = scale(wbalance_no_red_10p(res), out=res)
+    res[background] = img[background]
     return res
 
 
@@ -221,11 +580,66 @@ def recover_image_S4(img, B, illum, nmap):
     return scale(wbalance_no_red_gw(res))
 
 
+'''
+Grows the neighborhood seeded at (seed_x, seed_y): every
+unlabeled pixel 4-connected to the seed through pixels whose
+depth is within eps of the seed depth. The component is labeled
+inside a window around the seed that doubles until the component
+no longer touches an interior window edge, so the work is
+proportional to the region rather than to the whole image
+'''
+def grow_neighborhood(depths, nmap, seed_x, seed_y, eps, window=32):
+    height, width = depths.shape
+    seed_depth = depths[seed_x, seed_y]
+    while True:
+        x0, x1 = max(0, seed_x - window), min(height, seed_x + window + 1)
+        y0, y1 = max(0, seed_y - window), min(width, seed_y + window + 1)
+        band = np.logical_and(nmap[x0:x1, y0:y1] == 0, np.abs(depths[x0:x1, y0:y1] - seed_depth) <= eps)
+        labels, _ = sp.ndimage.label(band)
+        region = labels == labels[seed_x - x0, seed_y - y0]
+        if not ((x0 > 0 and np.any(region[0])) or (x1 < height and np.any(region[-1])) or
+                (y0 > 0 and np.any(region[:, 0])) or (y1 < width and np.any(region[:, -1]))):
+            return (slice(x0, x1), slice(y0, y1)), region
+        window *= 2
+
+'''
+Constructs a neighborhood map from depths and 
+epsilon. Seeds are taken in raster order from the
+first unlabeled pixel and each neighborhood is grown
+with grow_neighborhood
+'''
+def construct_neighborhood_map(depths, epsilon=0.05, engine='label'):
+    if engine == 'flood':
+        return construct_neighborhood_map_reference(depths, epsilon)
+    eps = (np.max(depths) - np.min(depths)) * epsilon
+    nmap = np.zeros(depths.shape, dtype=np.int32)
+    flat_nmap = nmap.reshape(-1)
+    n_neighborhoods = 1
+    pos, chunk = 0, 4096
+    while pos < flat_nmap.size:
+        unlabeled = np.flatnonzero(flat_nmap[pos:pos + chunk] == 0)
+        if len(unlabeled) == 0:
+            pos += chunk
+            continue
+        pos += unlabeled[0]
+        window, region = grow_neighborhood(depths, nmap, *np.unravel_index(pos, depths.shape), eps)
+        nmap[window][region] = n_neighborhoods
+        n_neighborhoods += 1
+    labels = np.arange(1, n_neighborhoods)
+    background_labels, background_sizes = np.unique(nmap[depths == 0], return_counts=True)
+    if len(background_labels) > 0:
+        #reset largest background to 0
+        labels = labels[labels != background_labels[np.argmax(background_sizes)]]
+        nmap = compact_labels(nmap, labels)
+    return nmap, len(labels)
+
 '''
 Constructs a neighborhood map from depths and 
-epsilon
+epsilon with a per-pixel flood fill from random
+seeds. Reference implementation for
+construct_neighborhood_map
 '''
-def construct_neighborhood_map(depths, epsilon=0.05):
+def construct_neighborhood_map_reference(depths, epsilon=0.05):
     eps = (np.max(depths) - np.min(depths)) * epsilon
     nmap = np.zeros_like(depths).astype(np.int32)
     n_neighborhoods = 1
@@ -261,6 +675,16 @@ def construct_neighborhood_map(depths, epsilon=0.05):
         nmap[nmap == zeros_size_arr[0][0]] = 0 #reset largest background to 0
     return nmap, n_neighborhoods - 1
 
+'''
+Relabels a neighborhood map with a single lookup table
+gather. The labels in keep become 1..len(keep) in the
+given order and every other label becomes 0
+'''
+def compact_labels(nmap, keep):
+    table = np.zeros(np.max(nmap) + 1, dtype=nmap.dtype)
+    table[keep] = np.arange(1, len(keep) + 1)
+    return table[nmap]
+
 '''
 Finds the closest nonzero label to a location
 '''
@@ -292,29 +716,64 @@ def find_closest_label(nmap, start_x, start_y):
                     q.append((x2, y2))
 
 
+'''
+Assigns every pixel in mask the closest nonzero label
+of nmap. The labels are looked up through the indices
+returned by a single Euclidean distance transform
+'''
+def fill_closest_labels(nmap, mask):
+    labeled = nmap != 0
+    if not np.any(labeled):
+        return nmap
+    idx_x, idx_y = sp.ndimage.distance_transform_edt(np.logical_not(labeled), return_distances=False, return_indices=True)
+    nmap[mask] = nmap[idx_x[mask], idx_y[mask]]
+    return nmap
+
 '''
 Refines the neighborhood map to remove artifacts
 '''
 def refine_neighborhood_map(nmap, min_size = 10, radius = 3):
-    refined_nmap = np.zeros_like(nmap)
-    vals, counts = np.unique(nmap, return_counts=True)
-    neighborhood_sizes = sorted(zip(vals, counts), key=lambda x: x[1], reverse=True)
-    num_labels = 1
-    for label, size in neighborhood_sizes:
-        if size >= min_size and label != 0:
-            refined_nmap[nmap == label] = num_labels
-            num_labels += 1
-    for label, size in neighborhood_sizes:
-        if size < min_size and label != 0:
-            for x, y in zip(*np.where(nmap == label)):
-                refined_nmap[x, y] = find_closest_label(refined_nmap, x, y)
+    counts = np.bincount(nmap.ravel())
+    counts[0] = 0
+    by_size = np.argsort(-counts, kind='stable')
+    large_labels = by_size[counts[by_size] >= max(min_size, 1)]
+    refined_nmap = compact_labels(nmap, large_labels)
+    is_small = np.logical_and(counts > 0, counts < min_size)
+    if np.any(is_small):
+        refined_nmap = fill_closest_labels(refined_nmap, is_small[nmap])
     refined_nmap = closing(refined_nmap, square(radius))
-    return refined_nmap, num_labels - 1
+    return refined_nmap, len(large_labels)
 
 
+'''
+rawpy postprocess options for a decode that will be shrunk to
+at most size_limit pixels: half_size (2x2 binning, no
+demosaic) when the half-size frame is still at least
+size_limit, otherwise the cheap linear demosaic when the frame
+will be shrunk at all, and 8 bits per sample. No options (a
+full quality decode) without a size limit
+'''
+def raw_decode_options(raw, size_limit=None):
+    if not size_limit:
+        return {}
+    longest = max(raw.sizes.width, raw.sizes.height)
+    if size_limit >= longest:
+        return {}
+    if 2 * size_limit <= longest:
+        return {'half_size': True, 'output_bps': 8}
+    return {'demosaic_algorithm': rawpy.DemosaicAlgorithm.LINEAR, 'output_bps': 8}
+
+'''
+Decodes a RAW file (a path or a file object) to 8-bit RGB,
+at reduced resolution when it will be shrunk to size_limit
+'''
+def decode_raw(img_fname, size_limit=None):
+    with rawpy.imread(img_fname) as raw:
+        return raw.postprocess(**raw_decode_options(raw, size_limit))
+
 def load_image_and_depth_map(img_fname, depths_fname, size_limit = 1024):
     depths = Image.open(depths_fname)
-    img = Image.fromarray(rawpy.imread(img_fname).postprocess())
+    img = Image.fromarray(decode_raw(img_fname, size_limit))
     img.thumbnail((size_limit, size_limit), Image.ANTIALIAS)
     depths = depths.resize(img.size, Image.ANTIALIAS)
     return np.float32(img) / 255.0, np.array(depths)
@@ -338,12 +797,63 @@ def wbalance_gw(img):
 
 
 '''
-White balance based on top 10% average values of each channel
+Mean of the largest fraction of the values, selected with
+a partial sort (np.partition) rather than a full sort
+'''
+def top_fraction_mean(values, fraction=0.1):
+    values = np.ravel(values)
+    k = int(round(np.size(values) * fraction))
+    if k == 0:
+        return np.mean(values)
+    return np.mean(np.partition(values, np.size(values) - k)[np.size(values) - k:])
+
+'''
+Streaming version of top_fraction_mean for every channel of
+an image that is fed tile by tile. Values are accumulated in
+fixed-width histogram bins over [lo, hi] (values outside fall
+in the end bins) with the exact sum of every bin, so only the
+bin holding the cut-off is approximated by its mean
 '''
-def wbalance_10p(img):
-    dr = 1.0 / np.mean(np.sort(img[:, :, 0], axis=None)[int(round(-1 * np.size(img[:, :, 0]) * 0.1)):])
-    dg = 1.0 / np.mean(np.sort(img[:, :, 1], axis=None)[int(round(-1 * np.size(img[:, :, 0]) * 0.1)):])
-    db = 1.0 / np.mean(np.sort(img[:, :, 2], axis=None)[int(round(-1 * np.size(img[:, :, 0]) * 0.1)):])
+class TopFractionStats(object):
+    def __init__(self, channels=3, bins=4096, lo=0.0, hi=1.0):
+        self.bins, self.lo, self.hi = bins, lo, hi
+        self.counts = np.zeros((channels, bins), dtype=np.int64)
+        self.sums = np.zeros((channels, bins))
+
+    def update(self, tile):
+        flat = tile.reshape(-1, self.counts.shape[0])
+        for c in range(self.counts.shape[0]):
+            idx = np.clip(((flat[:, c] - self.lo) * (self.bins / (self.hi - self.lo))).astype(np.intp), 0, self.bins - 1)
+            self.counts[c] += np.bincount(idx, minlength=self.bins)
+            self.sums[c] += np.bincount(idx, weights=flat[:, c], minlength=self.bins)
+
+    def means(self, fraction=0.1):
+        means = np.zeros(self.counts.shape[0])
+        for c in range(self.counts.shape[0]):
+            total = np.sum(self.counts[c])
+            k = int(round(total * fraction))
+            if k == 0:
+                means[c] = np.sum(self.sums[c]) / total
+                continue
+            counts_desc, sums_desc = self.counts[c][::-1], self.sums[c][::-1]
+            cum_counts = np.cumsum(counts_desc)
+            cut = np.searchsorted(cum_counts, k)
+            above = cum_counts[cut - 1] if cut > 0 else 0
+            partial = (k - above) * (sums_desc[cut] / counts_desc[cut])
+            means[c] = (np.sum(sums_desc[:cut]) + partial) / k
+        return means
+
+'''
+White balance based on top 10% average values of each channel.
+means can hold precomputed per-channel top 10% means, e.g.
+from TopFractionStats when the image is processed in tiles
+'''
+def wbalance_10p(img, means=None):
+    if means is None:
+        means = [top_fraction_mean(img[:, :, c]) for c in range(3)]
+    dr = 1.0 / means[0]
+    dg = 1.0 / means[1]
+    db = 1.0 / means[2]
     dsum = dr + dg + db
     dr = dr / dsum * 3.
     dg = dg / dsum * 3.
@@ -355,11 +865,15 @@ def wbalance_10p(img):
     return img
 
 '''
-White balance based on top 10% average values of blue and green channel
+White balance based on top 10% average values of blue and green channel.
+means can hold precomputed per-channel top 10% means, e.g.
+from TopFractionStats when the image is processed in tiles
 '''
-def wbalance_no_red_10p(img):
-    dg = 1.0 / np.mean(np.sort(img[:, :, 1], axis=None)[int(round(-1 * np.size(img[:, :, 0]) * 0.1)):])
-    db = 1.0 / np.mean(np.sort(img[:, :, 2], axis=None)[int(round(-1 * np.size(img[:, :, 0]) * 0.1)):])
+def wbalance_no_red_10p(img, means=None):
+    if means is None:
+        means = [None, top_fraction_mean(img[:, :, 1]), top_fraction_mean(img[:, :, 2])]
+    dg = 1.0 / means[1]
+    db = 1.0 / means[2]
     dsum = dg + db
     dg = dg / dsum * 2.
     db = db / dsum * 2.
@@ -383,12 +897,70 @@ def wbalance_no_red_gw(img):
     img[:, :, 2] *= db
     return img
 
-def scale(img):
-    return (img - np.min(img)) / (np.max(img) - np.min(img))
+def scale(img, out=None, bounds=None):
+    img_min, img_max = (np.min(img), np.max(img)) if bounds is None else bounds
+    res = np.subtract(img, img_min, out=out)
+    res /= (img_max - img_min)
+    return res
 
-def run_pipeline(img, depths, args):
+'''
+Stacks single-channel maps into one preallocated H x W x C
+array of the given dtype (their common type by default)
+'''
+def stack_channels(channels, dtype=None):
+    res = np.empty(channels[0].shape + (len(channels),), dtype=dtype or np.result_type(*channels))
+    for c, channel in enumerate(channels):
+        res[:, :, c] = channel
+    return res
+
+'''
+Fills in defaults for pipeline options that callers
+building their own args may not set
+'''
+def fill_pipeline_defaults(args):
     if 'output_graphs' not in args:
         args.output_graphs = False
+    if 'illumination_solver' not in args:
+        args.illumination_solver = 'closed_form'
+    if 'fit_agree' not in args:
+        args.fit_agree = None
+    if 'attenuation_samples' not in args:
+        args.attenuation_samples = None
+    if 'smoothing' not in args:
+        args.smoothing = 'bilateral'
+    if 'float32' not in args:
+        args.float32 = False
+    if 'estimate_size' not in args:
+        args.estimate_size = None
+    if 'sidecar' not in args:
+        args.sidecar = None
+    if 'save_sidecar' not in args:
+        args.save_sidecar = False
+    if 'lut_bins' not in args:
+        args.lut_bins = None
+    return args
+
+'''
+Neighborhood map used for illumination estimation and as the
+foreground mask at recovery
+'''
+def estimate_neighborhood_map(depths):
+    print('Constructing neighborhood map...', flush=True)
+    nmap, _ = construct_neighborhood_map(depths, 0.1)
+
+    print('Refining neighborhood map...', flush=True)
+    return refine_neighborhood_map(nmap, 50)
+
+'''
+Estimates the water parameters of an image: backscatter and
+wideband attenuation coefficients per channel (the latter
+without the l factor), the neighborhood map, the illuminant
+and the depths it was estimated at, along with the B and
+beta_D fields they give at this resolution
+'''
+def estimate_parameters(img, depths, args):
+    fill_pipeline_defaults(args)
+    work_dtype = np.float32 if args.float32 else None
     if args.output_graphs:
         plt.imshow(depths)
         plt.title('Depth Map')
@@ -398,9 +970,10 @@ def run_pipeline(img, depths, args):
     ptsR, ptsG, ptsB = find_backscatter_estimation_points(img, depths, fraction=0.01, min_depth_percent=args.min_depth)
 
     print('Finding backscatter coefficients...', flush=True)
-    Br, coefsR = find_backscatter_values(ptsR, depths, restarts=25)
-    Bg, coefsG = find_backscatter_values(ptsG, depths, restarts=25)
-    Bb, coefsB = find_backscatter_values(ptsB, depths, restarts=25)
+    Br, coefsR = find_backscatter_values(ptsR, depths, restarts=25, agree=args.fit_agree)
+    Bg, coefsG = find_backscatter_values(ptsG, depths, restarts=25, agree=args.fit_agree)
+    Bb, coefsB = find_backscatter_values(ptsB, depths, restarts=25, agree=args.fit_agree)
+    backscatter_coefs = [coefsR, coefsG, coefsB]
 
     if args.output_graphs:
         print('Coefficients: \n{}\n{}\n{}'.format(coefsR, coefsG, coefsB), flush=True)
@@ -432,33 +1005,31 @@ def run_pipeline(img, depths, args):
         plt.savefig('Bc_values.png')
         plt.show()
 
-    print('Constructing neighborhood map...', flush=True)
-    nmap, _ = construct_neighborhood_map(depths, 0.1)
-
-    print('Refining neighborhood map...', flush=True)
-    nmap, n = refine_neighborhood_map(nmap, 50)
+    nmap, n = estimate_neighborhood_map(depths)
     if args.output_graphs:
         plt.imshow(nmap)
         plt.title('Neighborhood map')
         plt.show()
 
     print('Estimating illumination...', flush=True)
-    illR = estimate_illumination(img[:, :, 0], Br, nmap, n, p=args.p, max_iters=100, tol=1E-5, f=args.f)
-    illG = estimate_illumination(img[:, :, 1], Bg, nmap, n, p=args.p, max_iters=100, tol=1E-5, f=args.f)
-    illB = estimate_illumination(img[:, :, 2], Bb, nmap, n, p=args.p, max_iters=100, tol=1E-5, f=args.f)
-    ill = np.stack([illR, illG, illB], axis=2)
+    B = stack_channels([Br, Bg, Bb], work_dtype)
+    del Br, Bg, Bb
+    ill, iters = estimate_illumination_multichannel(img, B, nmap, n, p=args.p, max_iters=100, tol=1E-5, f=args.f, solver=args.illumination_solver, return_iters=True, smoothing=args.smoothing)
+    print('Illumination iterations ({}): {} {} {}'.format(args.illumination_solver, *iters), flush=True)
+    illR, illG, illB = ill[:, :, 0], ill[:, :, 1], ill[:, :, 2]
     if args.output_graphs:
         plt.imshow(ill)
         plt.title('Illuminant map')
         plt.show()
 
     print('Estimating wideband attenuation...', flush=True)
-    beta_D_r, _ = estimate_wideband_attentuation(depths, illR)
-    refined_beta_D_r, coefsR = refine_wideband_attentuation(depths, illR, beta_D_r, radius_fraction=args.spread_data_fraction, l=args.l)
-    beta_D_g, _ = estimate_wideband_attentuation(depths, illG)
-    refined_beta_D_g, coefsG = refine_wideband_attentuation(depths, illG, beta_D_g, radius_fraction=args.spread_data_fraction, l=args.l)
-    beta_D_b, _ = estimate_wideband_attentuation(depths, illB)
-    refined_beta_D_b, coefsB = refine_wideband_attentuation(depths, illB, beta_D_b, radius_fraction=args.spread_data_fraction, l=args.l)
+    beta_D_r, _ = estimate_wideband_attentuation(depths, illR, smoothing=args.smoothing)
+    refined_beta_D_r, coefsR = refine_wideband_attentuation(depths, illR, beta_D_r, radius_fraction=args.spread_data_fraction, l=args.l, max_samples=args.attenuation_samples)
+    beta_D_g, _ = estimate_wideband_attentuation(depths, illG, smoothing=args.smoothing)
+    refined_beta_D_g, coefsG = refine_wideband_attentuation(depths, illG, beta_D_g, radius_fraction=args.spread_data_fraction, l=args.l, max_samples=args.attenuation_samples)
+    beta_D_b, _ = estimate_wideband_attentuation(depths, illB, smoothing=args.smoothing)
+    refined_beta_D_b, coefsB = refine_wideband_attentuation(depths, illB, beta_D_b, radius_fraction=args.spread_data_fraction, l=args.l, max_samples=args.attenuation_samples)
+    attenuation_coefs = [coefsR, coefsG, coefsB]
 
     if args.output_graphs:
         print('Coefficients: \n{}\n{}\n{}'.format(coefsR, coefsG, coefsB), flush=True)
@@ -499,10 +1070,99 @@ def run_pipeline(img, depths, args):
         plt.savefig('betaD_values.png')
         plt.show()
 
+    del beta_D_r, beta_D_g, beta_D_b, illR, illG, illB
+    beta_D = stack_channels([refined_beta_D_r, refined_beta_D_g, refined_beta_D_b], work_dtype)
+    del refined_beta_D_r, refined_beta_D_g, refined_beta_D_b
+    return {
+        'backscatter': backscatter_coefs,
+        'attenuation': attenuation_coefs,
+        'nmap': nmap,
+        'illuminant': ill,
+        'depths': depths,
+        'f': args.f,
+        'B': B,
+        'beta_D': beta_D,
+    }
+
+'''
+Evaluates fitted backscatter coefficients (or the linear
+fallback) at the given depths
+'''
+def evaluate_backscatter(depths, coefs):
+    if len(coefs) == 2:
+        return (coefs[0] * depths) + coefs[1]
+    return backscatter_model(depths, *coefs)
+
+'''
+Evaluates fitted wideband attenuation coefficients (or the
+linear fallback) at the given depths, scaled by l
+'''
+def evaluate_beta_D(depths, coefs, l=1.0):
+    if len(coefs) == 2:
+        return l * ((coefs[0] * depths) + coefs[1])
+    return l * calculate_beta_D(depths, *coefs)
+
+'''
+Downsamples an image and its depth map so that the longer
+side is at most size, for parameter estimation
+'''
+def downsample_for_estimation(img, depths, size):
+    small_depths = downsample_depths(depths, size)
+    small_img = resize(img, small_depths.shape + img.shape[2:], anti_aliasing=True, preserve_range=True).astype(img.dtype, copy=False)
+    return small_img, small_depths
+
+def downsample_depths(depths, size):
+    factor = size / max(depths.shape[:2])
+    shape = (max(1, int(round(depths.shape[0] * factor))), max(1, int(round(depths.shape[1] * factor))))
+    return resize(depths, shape, order=1, anti_aliasing=False, preserve_range=True).astype(depths.dtype, copy=False)
+
+'''
+Nearest-neighbour upsampling of a label map to shape
+'''
+def upsample_labels(nmap, shape):
+    rows = (np.arange(shape[0]) * nmap.shape[0]) // shape[0]
+    cols = (np.arange(shape[1]) * nmap.shape[1]) // shape[1]
+    return nmap[rows[:, None], cols[None, :]]
+
+'''
+Runs the full pipeline. With args.estimate_size the parameters
+are estimated on a copy downsampled to that size and applied
+to the image at its own resolution. With return_model the
+fitted model is returned along with the recovered image
+'''
+def run_pipeline(img, depths, args, return_model=False):
+    fill_pipeline_defaults(args)
+    work_dtype = None
+    if args.float32:
+        work_dtype = np.float32
+        img = img.astype(np.float32, copy=False)
+        depths = depths.astype(np.float32, copy=False)
+    if args.estimate_size and max(img.shape[:2]) > args.estimate_size:
+        small_img, small_depths = downsample_for_estimation(img, depths, args.estimate_size)
+        print('Estimating parameters at {}x{}...'.format(small_img.shape[1], small_img.shape[0]), flush=True)
+        model = estimate_parameters(small_img, small_depths, args)
+        del small_img, small_depths, model['B'], model['beta_D']
+        print('Applying parameters at {}x{}...'.format(img.shape[1], img.shape[0]), flush=True)
+        if args.lut_bins and not args.output_graphs:
+            nmap, B, beta_D = upsample_labels(model['nmap'], depths.shape), None, None
+        else:
+            nmap, B, beta_D = evaluate_model(model, depths, args.l, work_dtype)
+    else:
+        model = estimate_parameters(img, depths, args)
+        nmap, B, beta_D = model['nmap'], model.pop('B'), model.pop('beta_D')
+    if args.output_graphs or return_model:
+        ill = model['illuminant']
+    else:
+        del model['illuminant']
+
     print('Reconstructing image...', flush=True)
-    B = np.stack([Br, Bg, Bb], axis=2)
-    beta_D = np.stack([refined_beta_D_r, refined_beta_D_g, refined_beta_D_b], axis=2)
-    recovered = recover_image(img, depths, B, beta_D, nmap)
+    out = beta_D if args.float32 and not args.output_graphs else None
+    # the LUT only pays off when it replaces evaluating the models; exact fields are used as they are
+    if B is None:
+        lut = build_depth_lut(model, (np.min(depths), np.max(depths)), args.lut_bins, args.l, work_dtype or np.float64)
+        recovered = recover_image_lut(img, depths, lut, nmap, out=out)
+    else:
+        recovered = recover_image(img, depths, B, beta_D, nmap, out=out)
 
 
     if args.output_graphs:
@@ -530,28 +1190,398 @@ def run_pipeline(img, depths, args):
         plt.savefig('components.png')
         plt.show()
 
+    if return_model:
+        return recovered, model
     return recovered
 
+'''
+Recovers an image from an already fitted model (e.g. loaded
+from a sidecar) without estimating anything. If args.f differs
+from the f the model was fitted with, only the attenuation
+coefficients are refitted, from the stored low resolution
+illuminant. Models without a neighborhood map (dive models,
+see calibrate_water_model) get one built from the depths
+'''
+def apply_model(img, depths, model, args):
+    fill_pipeline_defaults(args)
+    work_dtype = None
+    if args.float32:
+        work_dtype = np.float32
+        img = img.astype(np.float32, copy=False)
+        depths = depths.astype(np.float32, copy=False)
+    if not np.isclose(args.f, model['f']):
+        print('Refitting wideband attenuation for f={}...'.format(args.f), flush=True)
+        model = refit_attenuation(model, args)
+    if 'nmap' not in model:
+        small_depths = depths
+        if args.estimate_size and max(depths.shape) > args.estimate_size:
+            small_depths = downsample_depths(depths, args.estimate_size)
+        model = dict(model, nmap=estimate_neighborhood_map(small_depths)[0])
+    print('Reconstructing image...', flush=True)
+    if args.lut_bins:
+        lut = build_depth_lut(model, (np.min(depths), np.max(depths)), args.lut_bins, args.l, work_dtype or np.float64)
+        return recover_image_lut(img, depths, lut, upsample_labels(model['nmap'], depths.shape))
+    nmap, B, beta_D = evaluate_model(model, depths, args.l, work_dtype)
+    return recover_image(img, depths, B, beta_D, nmap, out=beta_D if args.float32 else None)
+
+'''
+Refits the wideband attenuation coefficients of a model for
+a new f from its stored illuminant and depths
+'''
+def refit_attenuation(model, args):
+    if 'illuminant' not in model:
+        raise ValueError('Model was calibrated with f={} and has no illuminant to refit from; recalibrate it with f={}'.format(model['f'], args.f))
+    depths = model['depths']
+    ill = model['illuminant'] * (args.f / model['f'])
+    coefs = []
+    for c in range(3):
+        beta_D, _ = estimate_wideband_attentuation(depths, ill[:, :, c], smoothing=args.smoothing)
+        _, channel_coefs = refine_wideband_attentuation(depths, ill[:, :, c], beta_D, radius_fraction=args.spread_data_fraction, l=args.l, max_samples=args.attenuation_samples)
+        coefs.append(channel_coefs)
+    return dict(model, attenuation=coefs, illuminant=ill, f=args.f)
+
+'''
+Fits one water model for a set of frames from the same dive.
+Backscatter points from all frames are pooled into a single
+fit per channel. Each frame's illuminant is then estimated
+with that shared backscatter and the wideband attenuation
+estimates of all frames are pooled into a single fit per
+channel as well. frames is a list of (img, depths) pairs at
+estimation resolution; the model has no per-frame arrays
+'''
+def calibrate_water_model(frames, args):
+    fill_pipeline_defaults(args)
+    print('Calibrating water model from {} frames...'.format(len(frames)), flush=True)
+    points = [[], [], []]
+    for img, depths in frames:
+        for c, pts in enumerate(find_backscatter_estimation_points(img, depths, fraction=0.01, min_depth_percent=args.min_depth)):
+            points[c].append(pts)
+    depth_range = np.array([min(np.min(depths) for _, depths in frames), max(np.max(depths) for _, depths in frames)])
+    print('Finding backscatter coefficients...', flush=True)
+    backscatter_coefs = [find_backscatter_values(np.concatenate(pts), depth_range, restarts=25, agree=args.fit_agree)[1] for pts in points]
+
+    samples = [[], [], []]
+    for img, depths in frames:
+        nmap, n = estimate_neighborhood_map(depths)
+        print('Estimating illumination...', flush=True)
+        B = stack_channels([evaluate_backscatter(depths, coefs) for coefs in backscatter_coefs], np.float32 if args.float32 else None)
+        ill = estimate_illumination_multichannel(img, B, nmap, n, p=args.p, max_iters=100, tol=1E-5, f=args.f, solver=args.illumination_solver, smoothing=args.smoothing)
+        del B
+        for c in range(3):
+            beta_D, _ = estimate_wideband_attentuation(depths, ill[:, :, c], smoothing=args.smoothing)
+            samples[c].append((depths.ravel(), ill[:, :, c].ravel(), beta_D.ravel()))
+
+    print('Estimating wideband attenuation...', flush=True)
+    attenuation_coefs = []
+    for c in range(3):
+        depths, ill, beta_D = (np.concatenate(arrays) for arrays in zip(*samples[c]))
+        attenuation_coefs.append(refine_wideband_attentuation(depths, ill, beta_D, radius_fraction=args.spread_data_fraction, max_samples=args.attenuation_samples)[1])
+    return {'backscatter': backscatter_coefs, 'attenuation': attenuation_coefs, 'f': args.f, 'frames': len(frames)}
+
+'''
+Neighborhood map, B and beta_D of a model at the resolution
+of the given depths
+'''
+def evaluate_model(model, depths, l=1.0, dtype=None):
+    nmap = upsample_labels(model['nmap'], depths.shape)
+    B = stack_channels([evaluate_backscatter(depths, coefs) for coefs in model['backscatter']], dtype)
+    beta_D = stack_channels([evaluate_beta_D(depths, coefs, l) for coefs in model['attenuation']], dtype)
+    return nmap, B, beta_D
+
+'''
+Sidecar file names: a JSON file with the coefficients and
+settings and a .npz with the low resolution arrays
+'''
+def sidecar_paths(fname):
+    base = os.path.splitext(fname)[0]
+    return base + '.json', base + '.npz'
+
+'''
+Saves a fitted model as a sidecar. The arrays are shrunk so
+that their longer side is at most size, whatever resolution
+the model was fitted at, and the illuminant is stored without
+the f factor, in float16. Dive models have no arrays and are
+saved as the JSON file alone
+'''
+def save_model_sidecar(model, fname, size=1024):
+    json_fname, npz_fname = sidecar_paths(fname)
+    meta = {
+        'version': 1,
+        'backscatter': [[float(v) for v in coefs] for coefs in model['backscatter']],
+        'attenuation': [[float(v) for v in coefs] for coefs in model['attenuation']],
+        'f': float(model['f']),
+    }
+    if 'nmap' in model:
+        nmap, depths, ill = model['nmap'], model['depths'], model['illuminant']
+        if max(depths.shape) > size:
+            depths = downsample_depths(depths, size)
+            nmap = upsample_labels(nmap, depths.shape)
+            ill = resize(ill, depths.shape + ill.shape[2:], anti_aliasing=True, preserve_range=True)
+        np.savez_compressed(npz_fname, nmap=nmap.astype(np.int32), depths=depths.astype(np.float32),
+                            illuminant=(ill / model['f']).astype(np.float16))
+        meta['shape'] = list(nmap.shape)
+        meta['arrays'] = os.path.basename(npz_fname)
+    else:
+        meta['frames'] = model['frames']
+    with open(json_fname, 'w') as fp:
+        json.dump(meta, fp, indent=2)
+    return json_fname
+
+def load_model_sidecar(fname):
+    json_fname, _ = sidecar_paths(fname)
+    with open(json_fname) as fp:
+        meta = json.load(fp)
+    model = {
+        'backscatter': [np.array(coefs) for coefs in meta['backscatter']],
+        'attenuation': [np.array(coefs) for coefs in meta['attenuation']],
+        'f': meta['f'],
+    }
+    if 'arrays' not in meta:
+        model['frames'] = meta['frames']
+        return model
+    arrays = np.load(os.path.join(os.path.dirname(json_fname), meta['arrays']))
+    model['nmap'] = arrays['nmap']
+    model['depths'] = arrays['depths']
+    model['illuminant'] = arrays['illuminant'].astype(np.float32) * meta['f']
+    return model
+
 def preprocess_for_monodepth(img_fname, output_fname, size_limit=1024):
-    img = Image.fromarray(rawpy.imread(img_fname).postprocess())
+    img = Image.fromarray(decode_raw(img_fname, size_limit))
     img.thumbnail((size_limit, size_limit), Image.ANTIALIAS)
     img_adapteq = exposure.equalize_adapthist(np.array(img), clip_limit=0.03)
     Image.fromarray((np.round(img_adapteq * 255.0)).astype(np.uint8)).save(output_fname)
 
-def preprocess_sfm_depth_map(depths, min_depth, max_depth):
-    z_min = np.min(depths) + (min_depth * (np.max(depths) - np.min(depths)))
-    z_max = np.min(depths) + (max_depth * (np.max(depths) - np.min(depths)))
+def preprocess_sfm_depth_map(depths, min_depth, max_depth, depth_range=None):
+    d_min, d_max = (np.min(depths), np.max(depths)) if depth_range is None else depth_range
+    z_min = d_min + (min_depth * (d_max - d_min))
+    z_max = d_min + (max_depth * (d_max - d_min))
     if max_depth != 0:
         depths[depths == 0] = z_max
     depths[depths < z_min] = 0
     return depths
 
-def preprocess_monodepth_depth_map(depths, additive_depth, multiply_depth):
-    depths = ((depths - np.min(depths)) / (
-                np.max(depths) - np.min(depths))).astype(np.float32)
+def preprocess_monodepth_depth_map(depths, additive_depth, multiply_depth, depth_range=None):
+    d_min, d_max = (np.min(depths), np.max(depths)) if depth_range is None else depth_range
+    depths = ((depths - d_min) / (d_max - d_min)).astype(np.float32)
     depths = (multiply_depth * (1.0 - depths)) + additive_depth
     return depths
 
+'''
+Copies an array into a new memory-mapped .npy file
+'''
+def to_npy_memmap(array, fname):
+    res = np.lib.format.open_memmap(fname, mode='w+', dtype=array.dtype, shape=array.shape)
+    res[:] = array
+    res.flush()
+    return res
+
+'''
+Yields (start, stop) row ranges of at most tile_rows rows
+'''
+def tile_ranges(num_rows, tile_rows=256):
+    for start in range(0, num_rows, tile_rows):
+        yield start, min(num_rows, start + tile_rows)
+
+'''
+Minimum and maximum of an array, read tile by tile
+'''
+def tiled_min_max(array, tile_rows=256):
+    lo, hi = np.inf, -np.inf
+    for start, stop in tile_ranges(array.shape[0], tile_rows):
+        lo, hi = min(lo, np.min(array[start:stop])), max(hi, np.max(array[start:stop]))
+    return lo, hi
+
+'''
+Converts an integer image tile to float in [0, 1]
+'''
+def tile_as_float(tile, dtype=np.float32):
+    if np.issubdtype(tile.dtype, np.integer):
+        return tile.astype(dtype) / dtype(np.iinfo(tile.dtype).max)
+    return tile.astype(dtype, copy=False)
+
+'''
+Bilinear resize of a 2D array into out, a possibly
+memory-mapped array of the target shape, tile_rows rows at a
+time. Only the source rows a tile needs are read, so neither
+the source nor the result is ever held in memory whole
+'''
+def resize_tiled(array, out, tile_rows=256):
+    def axis_weights(src_len, dst_len):
+        pos = np.clip((np.arange(dst_len) + 0.5) * (src_len / dst_len) - 0.5, 0, src_len - 1)
+        lo = np.floor(pos).astype(np.intp)
+        return lo, np.minimum(lo + 1, src_len - 1), (pos - lo).astype(np.float32)
+    y0, y1, wy = axis_weights(array.shape[0], out.shape[0])
+    x0, x1, wx = axis_weights(array.shape[1], out.shape[1])
+    for start, stop in tile_ranges(out.shape[0], tile_rows):
+        # only the source rows this tile interpolates from are read
+        first = y0[start]
+        src = np.asarray(array[first:y1[stop - 1] + 1], dtype=np.float32)
+        def resample_rows(rows):
+            left, right = src[rows - first][:, x0], src[rows - first][:, x1]
+            return left + (right - left) * wx
+        top, bottom = resample_rows(y0[start:stop]), resample_rows(y1[start:stop])
+        out[start:stop] = top + (bottom - top) * wy[start:stop, None]
+    return out
+
+'''
+Opens a depth map for reading in strips. A .npy file is
+memory-mapped as it is; an image is decoded once by PIL (PIL
+has no partial decoding) and copied strip by strip into a
+float32 .npy in scratch_dir, after which the decoded image is
+released
+'''
+def open_depth_map_tiled(depths_fname, scratch_dir, tile_rows=256):
+    if depths_fname.lower().endswith('.npy'):
+        return np.load(depths_fname, mmap_mode='r')
+    with Image.open(depths_fname) as src:
+        width, height = src.size
+        res = np.lib.format.open_memmap(os.path.join(scratch_dir, 'depths_src.npy'), mode='w+', dtype=np.float32, shape=(height, width))
+        for start, stop in tile_ranges(height, tile_rows):
+            res[start:stop] = np.asarray(src.crop((0, start, width, stop)).convert('F'))
+    return res
+
+'''
+Writes an RGB image with values in [0, 1] as an 8-bit PNG,
+encoding tile_rows rows at a time so the frame is never held
+in memory. Rows use the PNG Sub filter
+'''
+def save_png_tiled(img, fname, tile_rows=256):
+    height, width = img.shape[:2]
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    compressor = zlib.compressobj(6)
+    with open(fname, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for start, stop in tile_ranges(height, tile_rows):
+            rows = np.round(np.asarray(img[start:stop]) * 255.0).astype(np.uint8).reshape(stop - start, width * 3)
+            filtered = np.empty((stop - start, width * 3 + 1), dtype=np.uint8)
+            filtered[:, 0] = 1
+            filtered[:, 1:4] = rows[:, :3]
+            np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                fp.write(chunk(b'IDAT', data))
+        fp.write(chunk(b'IDAT', compressor.flush()))
+        fp.write(chunk(b'IEND', b''))
+
+'''
+Shrinks an image by an integer factor, averaging factor x factor
+blocks and reading tile_rows rows at a time. Trailing rows and
+columns that do not fill a block are dropped
+'''
+def block_mean_tiled(img, factor, tile_rows=256, dtype=np.float32):
+    height, width = img.shape[0] // factor, img.shape[1] // factor
+    res = np.empty((height, width) + img.shape[2:], dtype=dtype)
+    step = max(1, tile_rows // factor)
+    for start, stop in tile_ranges(height, step):
+        tile = tile_as_float(img[start * factor:stop * factor, :width * factor], dtype)
+        res[start:stop] = tile.reshape((stop - start, factor, width, factor) + img.shape[2:]).mean(axis=(1, 3))
+    return res
+
+'''
+Tiled version of recover_image for images that do not fit in
+memory. img, depths and out can be memory-mapped; B and beta_D
+are evaluated per tile from the fitted coefficients in model
+and the (possibly lower resolution) neighborhood map is
+upsampled per tile, or looked up in a depth LUT if one is
+given. A first pass writes the clipped recovery
+and gathers the white balance histograms and channel extremes,
+a second pass applies the white balance and scale in place
+'''
+def recover_image_tiled(img, depths, model, out, l=1.0, tile_rows=256, lut=None):
+    height, width = depths.shape
+    nmap = model['nmap']
+    nmap_rows = (np.arange(height) * nmap.shape[0]) // height
+    nmap_cols = (np.arange(width) * nmap.shape[1]) // width
+    stats = TopFractionStats(channels=3)
+    mins, maxs = np.full(3, np.inf), np.full(3, -np.inf)
+    for start, stop in tile_ranges(height, tile_rows):
+        img_tile = tile_as_float(img[start:stop])
+        z = np.asarray(depths[start:stop], dtype=np.float32)
+        res = np.empty(img_tile.shape, dtype=np.float32)
+        if lut is not None:
+            apply_depth_lut(img_tile, z, lut, out=res)
+        else:
+            for c in range(3):
+                beta_D = evaluate_beta_D(z, model['attenuation'][c], l)
+                res[:, :, c] = (img_tile[:, :, c] - evaluate_backscatter(z, model['backscatter'][c])) * np.exp(beta_D * z)
+        np.clip(res, 0.0, 1.0, out=res)
+        res[nmap[nmap_rows[start:stop, None], nmap_cols[None, :]] == 0] = 0
+        stats.update(res)
+        mins = np.minimum(mins, np.min(res, axis=(0, 1)))
+        maxs = np.maximum(maxs, np.max(res, axis=(0, 1)))
+        out[start:stop] = res
+    means = stats.means()
+    # white balance gains are positive, so the balanced extremes are the balanced channel extremes
+    extremes = wbalance_no_red_10p(np.stack([mins, maxs])[:, None, :], means)
+    bounds = (np.min(extremes[0]), np.max(extremes[1]))
+    for start, stop in tile_ranges(height, tile_rows):
+        res = np.array(out[start:stop], dtype=np.float32)
+        res = scale(wbalance_no_red_10p(res, means), out=res, bounds=bounds)
+        background = nmap[nmap_rows[start:stop, None], nmap_cols[None, :]] == 0
+        res[background] = tile_as_float(img[start:stop])[background]
+        out[start:stop] = res
+    return out
+
+'''
+Out-of-core pipeline for full-resolution frames. The decoded
+image, the depth map and the output are memory-mapped to .npy
+files in scratch_dir, parameters are estimated on a copy shrunk
+by an integer factor to at most args.estimate_size pixels and
+recovery runs tile by tile. Peak memory is the largest of:
+the RAW decode (LibRaw's buffers plus the 3 bytes/pixel frame
+it returns, which is copied to disk and dropped), a depth map
+in an image format, which PIL decodes whole (1 byte/pixel for
+8-bit, 2-4 for 16-bit and 4 for float; a .npy depth map is
+read in strips instead), and the tile work, about 50 bytes per
+tile pixel. PNG output is encoded in strips; other formats are
+encoded by PIL from a full 8-bit frame (7 bytes/pixel)
+'''
+def run_pipeline_tiled(img_fname, depths_fname, output_fname, args, scratch_dir):
+    fill_pipeline_defaults(args)
+    estimate_size = args.estimate_size or 1024
+    img = to_npy_memmap(decode_raw(img_fname), os.path.join(scratch_dir, 'image.npy'))
+    height, width = img.shape[:2]
+    depths = np.lib.format.open_memmap(os.path.join(scratch_dir, 'depths.npy'), mode='w+', dtype=np.float32, shape=(height, width))
+    resize_tiled(open_depth_map_tiled(depths_fname, scratch_dir, args.tile_rows), depths, args.tile_rows)
+    depth_range = tiled_min_max(depths, args.tile_rows)
+    for start, stop in tile_ranges(height, args.tile_rows):
+        if args.monodepth:
+            depths[start:stop] = preprocess_monodepth_depth_map(depths[start:stop], args.monodepth_add_depth, args.monodepth_multiply_depth, depth_range)
+        else:
+            depths[start:stop] = preprocess_sfm_depth_map(np.array(depths[start:stop]), args.min_depth, args.max_depth, depth_range)
+    factor = max(1, -(-max(height, width) // estimate_size))
+    small_img = block_mean_tiled(img, factor, args.tile_rows)
+    rows = np.arange(small_img.shape[0]) * factor + factor // 2
+    cols = np.arange(small_img.shape[1]) * factor + factor // 2
+    small_depths = np.array(depths[rows[:, None], cols[None, :]])
+    if args.sidecar:
+        model = load_model_sidecar(args.sidecar)
+        if not np.isclose(args.f, model['f']):
+            print('Refitting wideband attenuation for f={}...'.format(args.f), flush=True)
+            model = refit_attenuation(model, args)
+        if 'nmap' not in model:
+            model = dict(model, nmap=estimate_neighborhood_map(small_depths)[0])
+    else:
+        print('Estimating parameters at {}x{}...'.format(small_img.shape[1], small_img.shape[0]), flush=True)
+        model = estimate_parameters(small_img, small_depths, args)
+        if args.save_sidecar:
+            print('Saved model to {}'.format(save_model_sidecar(model, output_fname)), flush=True)
+    print('Recovering {}x{} image in tiles of {} rows...'.format(width, height, args.tile_rows), flush=True)
+    out = np.lib.format.open_memmap(os.path.join(scratch_dir, 'output.npy'), mode='w+', dtype=np.float32, shape=img.shape)
+    lut = None
+    if args.lut_bins:
+        lut = build_depth_lut(model, tiled_min_max(depths, args.tile_rows), args.lut_bins, args.l, np.float32)
+    recover_image_tiled(img, depths, model, out, args.l, args.tile_rows, lut)
+    if output_fname.lower().endswith('.png'):
+        save_png_tiled(out, output_fname, args.tile_rows)
+        return
+    encoded = np.empty(img.shape, dtype=np.uint8)
+    for start, stop in tile_ranges(out.shape[0], args.tile_rows):
+        encoded[start:stop] = np.round(out[start:stop] * 255.0)
+    Image.fromarray(encoded).save(output_fname)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--image', required=True, help='Input image')
@@ -565,6 +1595,18 @@ if __name__ == '__main__':
     parser.add_argument('--spread-data-fraction', type=float, default=0.01, help='Require data to be this fraction of depth range away from each other in attenuation estimations')
     parser.add_argument('--size', type=int, default=320, help='Size to output')
     parser.add_argument('--output-graphs', action='store_true', help='Output graphs')
+    parser.add_argument('--illumination-solver', default='closed_form', choices=['closed_form', 'segmented', 'loop'], help='Solver for the local space average colour')
+    parser.add_argument('--fit-agree', type=int, default=None, help='Fit backscatter restarts this many at a time and stop once this many agree on the best loss (faster, but may pick different coefficients than fitting all restarts)')
+    parser.add_argument('--attenuation-samples', type=int, default=None, help='Fit wideband attenuation on at most this many depth-stratified pixels')
+    parser.add_argument('--smoothing', default='bilateral', choices=sorted(SMOOTHING_BACKENDS), help='Edge-preserving smoothing backend')
+    parser.add_argument('--float32', action='store_true', help='Run the pipeline in float32 with preallocated buffers')
+    parser.add_argument('--estimate-size', type=int, default=None, help='Estimate parameters on a copy downsampled to this size and apply them at full size')
+    parser.add_argument('--lut-bins', type=int, default=None, help='Apply backscatter and attenuation through depth lookup tables with this many bins')
+    parser.add_argument('--save-sidecar', action='store_true', help='Save the fitted model next to the output (.json + .npz)')
+    parser.add_argument('--sidecar', default=None, help='Apply-only: recover the image from this fitted model sidecar, skipping estimation')
+    parser.add_argument('--tiled', action='store_true', help='Recover the full-resolution image tile by tile from memory-mapped .npy files (--size is ignored; parameters are estimated at --estimate-size, default 1024; --depth-map may be a .npy file)')
+    parser.add_argument('--tile-rows', type=int, default=256, help='Rows per tile for --tiled')
+    parser.add_argument('--scratch-dir', default=None, help='Directory for the --tiled .npy files (default: a temporary directory)')
     parser.add_argument('--preprocess-for-monodepth', action='store_true', help='Preprocess for monodepth depth maps')
     parser.add_argument('--monodepth', action='store_true', help='Preprocess for monodepth')
     parser.add_argument('--monodepth-add-depth', type=float, default=2.0, help='Additive value for monodepth map')
@@ -574,6 +1616,16 @@ if __name__ == '__main__':
 
     if args.preprocess_for_monodepth:
         preprocess_for_monodepth(args.image, args.output, args.size)
+    elif args.tiled:
+        print('Loading image...', flush=True)
+        scratch_dir = args.scratch_dir or tempfile.mkdtemp(prefix='seathru-')
+        os.makedirs(scratch_dir, exist_ok=True)
+        try:
+            run_pipeline_tiled(args.image, args.depth_map, args.output, args, scratch_dir)
+        finally:
+            if args.scratch_dir is None:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+        print('Done.')
     else:
         print('Loading image...', flush=True)
         img, depths = load_image_and_depth_map(args.image, args.depth_map, args.size)
@@ -581,7 +1633,12 @@ if __name__ == '__main__':
             depths = preprocess_monodepth_depth_map(depths, args.monodepth_add_depth, args.monodepth_multiply_depth)
         else:
             depths = preprocess_sfm_depth_map(depths, args.min_depth, args.max_depth)
-        recovered = run_pipeline(img, depths, args)
+        if args.sidecar:
+            recovered = apply_model(img, depths, load_model_sidecar(args.sidecar), args)
+        else:
+            recovered, model = run_pipeline(img, depths, args, return_model=True)
+            if args.save_sidecar:
+                print('Saved model to {}'.format(save_model_sidecar(model, args.output)), flush=True)
         if args.equalize_image:
             recovered = exposure.equalize_adapthist(np.array(recovered), clip_limit=0.03)
             sigma_est = estimate_sigma(recovered, multichannel=True, average_sigmas=True)
@@ -0,0 +1,71 @@
+"""
+Message format shared by the Sea-Thru pynng service, the batch
+coordinator and their workers and clients.
+
+A message is a JSON header followed by an optional binary payload:
+a 4-byte big-endian header length, the UTF-8 JSON header, then the
+payload (encoded image bytes, PNG output or an .npy depth map).
+Kept free of torch and the pipeline so clients start quickly.
+"""
+
+import io
+import os
+import glob
+import json
+import struct
+
+import numpy as np
+
+DEFAULT_ADDRESS = 'ipc:///tmp/seathru.ipc'
+# Coordinator sockets: jobs are pushed to workers, results pulled back
+DEFAULT_JOBS_ADDRESS = 'tcp://127.0.0.1:5560'
+DEFAULT_RESULTS_ADDRESS = 'tcp://127.0.0.1:5561'
+
+# Pipeline settings a request may override for itself, with their types
+REQUEST_PARAMS = {
+    'f': float, 'l': float, 'p': float, 'min_depth': float, 'max_depth': float, 'spread_data_fraction': float,
+    'monodepth_add_depth': float, 'monodepth_multiply_depth': float,
+    'max_size': int, 'estimate_size': int, 'lut_bins': int,
+}
+
+
+def encode_message(header, payload=b''):
+    """Pack a JSON header and a binary payload into one message"""
+    header_bytes = json.dumps(header).encode('utf-8')
+    return struct.pack('>I', len(header_bytes)) + header_bytes + payload
+
+
+def decode_message(message):
+    """Split a message into its header dict and payload bytes"""
+    size, = struct.unpack('>I', message[:4])
+    return json.loads(message[4:4 + size].decode('utf-8')), message[4 + size:]
+
+
+def encode_array(array):
+    """Serialize an array as .npy bytes"""
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_array(payload):
+    """Deserialize .npy bytes"""
+    return np.load(io.BytesIO(payload), allow_pickle=False)
+
+
+def find_images(input_dir, raw=False):
+    """Sorted image files of a directory (and RAW files with raw)"""
+    image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.JPG', '*.JPEG', '*.PNG']
+    if raw:
+        image_extensions.extend(['*.raw', '*.RAW', '*.dng', '*.DNG'])
+
+    image_files = []
+    for ext in image_extensions:
+        image_files.extend(glob.glob(os.path.join(input_dir, ext)))
+    return sorted(image_files)
+
+
+def output_path_for(image_path, output_dir):
+    """Batch output file for an input image"""
+    name_without_ext = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(output_dir, f"{name_without_ext}_seathru.png")